@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reproduce the burst of registration submissions when a cohort opens: many
+users POST ``SubmitRegistration`` at once against a running dataserver.
+Reports throughput, latency percentiles and response statuses, along with
+the transaction retries counted by the ``RegistrationMetrics`` admin view.
+
+The users must already exist, named by ``--user-format``, and the
+registration rules and sessions must be uploaded. Run from the repository
+root::
+
+	python benchmarks/bench_submit_burst.py --url http://localhost:8082 \\
+		--registration-id Cohort2016 --users 500 --concurrency 50 \\
+		--admin admin@nextthought.com:temp001
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import time
+import argparse
+
+from collections import Counter
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+SUBMIT_PATH = '/dataserver2/users/%s/SubmitRegistration'
+METRICS_PATH = '/dataserver2/registration/RegistrationMetrics'
+
+def _parse_args():
+	parser = argparse.ArgumentParser( description='Registration submission burst' )
+	parser.add_argument( '--url', default='http://localhost:8082' )
+	parser.add_argument( '--registration-id', required=True )
+	parser.add_argument( '--users', type=int, default=200 )
+	parser.add_argument( '--concurrency', type=int, default=50 )
+	parser.add_argument( '--user-format', default='burst.user.%d' )
+	parser.add_argument( '--password', default='temp001' )
+	parser.add_argument( '--admin', help='user:password to read retry metrics' )
+	parser.add_argument( '--school', default='Federick, Lilla G. Middle' )
+	parser.add_argument( '--grade', default='6' )
+	parser.add_argument( '--course', required=True, help='the course NTIID' )
+	parser.add_argument( '--session', default='July 25-26 (M/T)' )
+	return parser.parse_args()
+
+def _get_metrics(args):
+	if not args.admin:
+		return {}
+	res = requests.get( args.url + METRICS_PATH,
+						auth=tuple( args.admin.split( ':', 1 ) ) )
+	res.raise_for_status()
+	return res.json().get( 'Items', {} )
+
+def _submit(args, i):
+	username = args.user_format % i
+	data = {'registration_id': args.registration_id,
+			'school': args.school,
+			'grade': args.grade,
+			'course': args.course,
+			'session': args.session,
+			'employee_id': 'burst-%d' % i,
+			'survey_text': 'burst'}
+	start = time.time()
+	try:
+		res = requests.post( args.url + SUBMIT_PATH % username,
+							 json=data,
+							 auth=(username, args.password) )
+		status = res.status_code
+	except requests.RequestException:
+		status = 'error'
+	return status, time.time() - start
+
+def _percentile(values, percent):
+	index = min( int( len( values ) * percent / 100 ), len( values ) - 1 )
+	return values[index]
+
+def main():
+	args = _parse_args()
+	before = _get_metrics( args )
+
+	pool = ThreadPool( args.concurrency )
+	start = time.time()
+	results = pool.map( lambda i: _submit( args, i ), range( args.users ) )
+	elapsed = time.time() - start
+	pool.close()
+
+	after = _get_metrics( args )
+	statuses = Counter( x[0] for x in results )
+	latencies = sorted( x[1] for x in results )
+	print( 'submissions  %8d' % len( results ) )
+	print( 'elapsed      %8.2f s' % elapsed )
+	print( 'throughput   %8.2f /s' % (len( results ) / elapsed) )
+	for percent in (50, 95, 99):
+		print( 'p%-11d %8.1f ms' % (percent, _percentile( latencies, percent ) * 1000) )
+	for status, count in sorted( statuses.items(), key=lambda x: str( x[0] ) ):
+		print( 'status %-5s %8d' % (status, count) )
+	for name in sorted( after ):
+		print( '%-20s %8d' % (name, after[name] - before.get( name, 0 )) )
+
+if __name__ == '__main__':
+	main()
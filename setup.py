@@ -44,6 +44,9 @@ setup(
 	],
 	extras_require={
 		'test': TESTS_REQUIRE,
+		'arrow': [
+			'pyarrow',
+		],
 		'docs': [
 			'Sphinx',
 			'repoze.sphinx.autointerface',
@@ -21,14 +21,44 @@ REGISTRATION_AVAILABLE_SESSIONS = 'RegistrationAvailableSessions'
 #: A POST view to submit registration/survey.
 SUBMIT_REGISTRATION_INFO = 'SubmitRegistration'
 
+#: A view to poll the state of a deferred registration enrollment.
+REGISTRATION_ENROLLMENT_STATUS = 'RegistrationEnrollmentStatus'
+
 #: A view to return enrollment rules for registration data.
 REGISTRATION_ENROLL_RULES = 'RegistrationEnrollRules'
 
 #: The admin view to fetch registration csv.
 REGISTRATION_READ_VIEW = 'Registrations'
 
+#: The admin view to fetch pages of registration data as JSON.
+REGISTRATION_PAGED_READ_VIEW = 'PagedRegistrations'
+
+#: The admin view to import registration and survey rows in bulk.
+REGISTRATION_IMPORT_VIEW = 'ImportRegistrations'
+
+#: The admin view to fetch the progress of a registration import.
+REGISTRATION_IMPORT_STATUS_VIEW = 'RegistrationImportStatus'
+
+#: The admin view to fetch the progress of a batched registration removal.
+REGISTRATION_REMOVAL_STATUS_VIEW = 'RegistrationRemovalStatus'
+
+#: The admin view to fetch aggregated registration counts.
+REGISTRATION_STATS_VIEW = 'RegistrationStatistics'
+
+#: The admin view to fetch process-wide registration metrics.
+REGISTRATION_METRICS_VIEW = 'RegistrationMetrics'
+
 #: The admin view to update registration information.
 REGISTRATION_UPDATE_VIEW = 'UpdateRegistrations'
 
 #: The admin view to fetch registration and survey csv.
 REGISTRATION_SURVEY_READ_VIEW = 'RegistrationSurveys'
+
+#: The admin view to start a background registration export.
+REGISTRATION_EXPORT_JOB_VIEW = 'StartRegistrationExport'
+
+#: The admin view to fetch the progress of a background export.
+REGISTRATION_EXPORT_STATUS_VIEW = 'RegistrationExportStatus'
+
+#: The admin view to download a finished background export.
+REGISTRATION_EXPORT_DOWNLOAD_VIEW = 'RegistrationExportDownload'
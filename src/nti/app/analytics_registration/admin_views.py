@@ -13,14 +13,14 @@ import csv
 
 from collections import namedtuple
 
-from io import BytesIO
-
 from requests.structures import CaseInsensitiveDict
 
 from zope import interface
 
 from zope.cachedescriptors.property import Lazy
 
+from zope.component.hooks import getSite
+
 from zope.container.contained import Contained
 
 from zope.traversing.interfaces import IPathAdapter
@@ -33,39 +33,135 @@ from nti.app.analytics_registration import MessageFactory as _
 
 from nti.app.analytics_registration import REGISTRATION
 from nti.app.analytics_registration import REGISTRATION_READ_VIEW
+from nti.app.analytics_registration import REGISTRATION_STATS_VIEW
+from nti.app.analytics_registration import REGISTRATION_IMPORT_VIEW
+from nti.app.analytics_registration import REGISTRATION_METRICS_VIEW
 from nti.app.analytics_registration import REGISTRATION_UPDATE_VIEW
 from nti.app.analytics_registration import REGISTRATION_ENROLL_RULES
+from nti.app.analytics_registration import REGISTRATION_EXPORT_JOB_VIEW
+from nti.app.analytics_registration import REGISTRATION_PAGED_READ_VIEW
+from nti.app.analytics_registration import REGISTRATION_EXPORT_STATUS_VIEW
+from nti.app.analytics_registration import REGISTRATION_IMPORT_STATUS_VIEW
+from nti.app.analytics_registration import REGISTRATION_REMOVAL_STATUS_VIEW
+from nti.app.analytics_registration import REGISTRATION_EXPORT_DOWNLOAD_VIEW
 from nti.app.analytics_registration import REGISTRATION_SURVEY_READ_VIEW
 from nti.app.analytics_registration import REGISTRATION_AVAILABLE_SESSIONS
 
 from nti.analytics_registration.registration import get_user_registrations
+from nti.analytics_registration.registration import get_registration_rules
 from nti.analytics_registration.registration import store_registration_rules
 from nti.analytics_registration.registration import delete_user_registrations
+from nti.analytics_registration.registration import get_registration_sessions
 from nti.analytics_registration.registration import store_registration_sessions
 
+from nti.app.analytics_registration.courses import get_course_resolver
+
+from nti.app.analytics_registration.counters import TOTAL
+from nti.app.analytics_registration.counters import COUNTED_DIMENSIONS
+
+from nti.app.analytics_registration.counters import get_session_seats
+from nti.app.analytics_registration.counters import tally_registrations
+from nti.app.analytics_registration.counters import rebuild_session_seats
+from nti.app.analytics_registration.counters import get_registration_counters
+from nti.app.analytics_registration.counters import start_registration_counts
+
+from nti.app.analytics_registration.exporters import make_export_job
+from nti.app.analytics_registration.exporters import iter_in_transaction
+from nti.app.analytics_registration.exporters import RegistrationExporter
+from nti.app.analytics_registration.exporters import RegistrationSurveyExporter
+
+from nti.app.analytics_registration.formats import FORMAT_CSV
+from nti.app.analytics_registration.formats import FORMAT_ARROW
+from nti.app.analytics_registration.formats import FORMAT_NDJSON
+from nti.app.analytics_registration.formats import FORMAT_PARQUET
+from nti.app.analytics_registration.formats import EXPORT_FORMATS
+
+from nti.app.analytics_registration.formats import has_arrow
+from nti.app.analytics_registration.formats import iter_arrow
+from nti.app.analytics_registration.formats import iter_ndjson
+from nti.app.analytics_registration.formats import arrow_schema
+from nti.app.analytics_registration.formats import iter_parquet
+from nti.app.analytics_registration.formats import normalize_record
+
+from nti.app.analytics_registration.importer import ImportRowError
+from nti.app.analytics_registration.importer import RegistrationImporter
+from nti.app.analytics_registration.importer import MAX_IMPORT_BATCH_SIZE
+from nti.app.analytics_registration.importer import DEFAULT_IMPORT_BATCH_SIZE
+
+from nti.app.analytics_registration.importer import parse_import_row
+from nti.app.analytics_registration.importer import iter_csv_records
+from nti.app.analytics_registration.importer import iter_ndjson_records
+from nti.app.analytics_registration.importer import validate_import_row
+
+from nti.app.analytics_registration.instrumentation import PHASE_CSV
+from nti.app.analytics_registration.instrumentation import PHASE_PARSE
+from nti.app.analytics_registration.instrumentation import PHASE_STORAGE
+from nti.app.analytics_registration.instrumentation import PHASE_ENROLLMENT
+
+from nti.app.analytics_registration.instrumentation import time_phase
+from nti.app.analytics_registration.instrumentation import timed_view
+
+from nti.app.analytics_registration.jobs import JOB_SUCCESS
+
+from nti.app.analytics_registration.metrics import to_prometheus
+from nti.app.analytics_registration.metrics import get_registration_metrics
+
+from nti.app.analytics_registration.ordering import cap_watermark
+from nti.app.analytics_registration.ordering import encode_cursor
+from nti.app.analytics_registration.ordering import decode_cursor
+from nti.app.analytics_registration.ordering import parse_watermark
+from nti.app.analytics_registration.ordering import registrations_after
+from nti.app.analytics_registration.ordering import registration_sort_key
+
+from nti.app.analytics_registration.questions import get_list_columns
+
+from nti.app.analytics_registration.removal import RegistrationRemover
+from nti.app.analytics_registration.removal import MAX_REMOVAL_BATCH_SIZE
+
+from nti.app.analytics_registration.removal import uncount_registrations
+from nti.app.analytics_registration.removal import unenroll_registrations
+
+from nti.app.analytics_registration.rules import get_rule_index
+from nti.app.analytics_registration.rules import invalidate_registration_rules
+
 from nti.app.analytics_registration.view_mixins import RegistrationCSVMixin
 from nti.app.analytics_registration.view_mixins import RegistrationIDViewMixin
+from nti.app.analytics_registration.view_mixins import RegistrationJobViewMixin
+from nti.app.analytics_registration.view_mixins import RegistrationCSVUploadMixin
 from nti.app.analytics_registration.view_mixins import RegistrationSurveyCSVMixin
 
+from nti.app.analytics_registration.views import RegistrationData
+
 from nti.app.base.abstract_views import get_source
 from nti.app.base.abstract_views import AbstractAuthenticatedView
 
+from nti.app.externalization.error import raise_json_error
+
 from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
 
-from nti.contenttypes.courses.interfaces import ICourseInstance
-from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
+from nti.common.string import is_true
 
 from nti.dataserver import authorization as nauth
 
 from nti.dataserver.users import User
 
+from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
 
-from nti.ntiids.ntiids import find_object_with_ntiid
-
 CLASS = StandardExternalFields.CLASS
+ITEMS = StandardExternalFields.ITEMS
+ITEM_COUNT = StandardExternalFields.ITEM_COUNT
 LAST_MODIFIED = StandardExternalFields.LAST_MODIFIED
 
+#: The response header holding the watermark of an export.
+WATERMARK_HEADER = 'X-Registration-Watermark'
+
+#: The default number of registrations returned per page.
+DEFAULT_PAGE_SIZE = 100
+
+#: The largest number of registrations returned per page.
+MAX_PAGE_SIZE = 1000
+
 @interface.implementer(IPathAdapter)
 class RegistrationPathAdapter(Contained):
 
@@ -82,46 +178,135 @@ class RegistrationPathAdapter(Contained):
 			 context=RegistrationPathAdapter,
 			 request_method='GET',
 			 name=REGISTRATION_READ_VIEW)
+@timed_view
 class RegistrationCSVView( AbstractAuthenticatedView,
 						   RegistrationCSVMixin,
 						   RegistrationIDViewMixin):
 	"""
 	An admin view to fetch all registration data.
+
+	params:
+		* registration_id
+		* user - (optional) only export this user's registrations
+		* since - (optional) only export registrations after this
+		  watermark, or timestamp in seconds since the epoch. The response's
+		  `X-Registration-Watermark` header holds the watermark to pass
+		  next time; it is never later than `WATERMARK_LAG` seconds ago,
+		  so the latest registrations may be exported again.
+		* format - (optional) `csv` (the default), `ndjson`, or, when
+		  pyarrow is installed, `arrow` or `parquet`
+		* stream - (optional) stream the output in chunks. Rows are built
+		  as the response is written, in a read-only transaction of their
+		  own, up to the last registration the request found; parquet
+		  files are still built before they are sent.
 	"""
 
-	def _get_header_row(self):
-		return self._get_registration_header_row()
+	def _get_since(self, values):
+		since = values.get( 'since' )
+		if not since:
+			return None
+		try:
+			return parse_watermark( since )
+		except ValueError:
+			raise hexc.HTTPUnprocessableEntity( _('Invalid since param.') )
+
+	def _get_format(self, values):
+		result = (values.get( 'format' ) or FORMAT_CSV).lower()
+		if result not in EXPORT_FORMATS:
+			raise hexc.HTTPUnprocessableEntity( _('Unknown export format.') )
+		if result in (FORMAT_ARROW, FORMAT_PARQUET) and not has_arrow():
+			raise hexc.HTTPUnprocessableEntity( _('Export format is not available.') )
+		return result
+
+	def _iter_csv_chunks(self, registrations):
+		rows = self._iter_row_data( registrations )
+		return self._iter_csv( self._get_header_row(), rows )
+
+	def _iter_format_chunks(self, export_format, registrations):
+		records = self._iter_row_data( registrations, self._get_record )
+		if export_format == FORMAT_NDJSON:
+			return iter_ndjson( normalize_record( x ) for x in records )
 
-	def _get_row_data(self, registration):
-		return self._get_registration_row_data( registration )
+		records = (normalize_record( x ) for x in records)
+		layout = self._get_survey_layout()
+		survey_columns = list_columns = ()
+		if layout is not None:
+			survey_columns = layout.columns
+			list_columns = get_list_columns( self._get_registration_id(), layout )
+		schema = arrow_schema( self._registration_header_row,
+							   survey_columns,
+							   list_columns )
+		if export_format == FORMAT_ARROW:
+			return iter_arrow( records, schema )
+		return iter_parquet( records, schema )
+
+	def _iter_chunks(self, export_format, registrations):
+		if export_format == FORMAT_CSV:
+			return self._iter_csv_chunks( registrations )
+		return self._iter_format_chunks( export_format, registrations )
+
+	def _iter_streamed_chunks(self, export_format, username, registration_id, since, until):
+		"""
+		Yield the chunks of the registrations after `since`, up to and
+		including `until`, read again in the streaming transaction.
+		"""
+		registrations = self._get_registrations( username, registration_id )
+		registrations = [x for x in registrations
+						 if (since is None or registration_sort_key( x ) > since)
+						 and registration_sort_key( x ) <= until]
+		for chunk in self._iter_chunks( export_format, registrations ):
+			yield chunk
 
 	def __call__(self):
 		values = CaseInsensitiveDict( self.request.params )
 		username = values.get( 'user' ) or values.get( 'username' )
 		registration_id = self._get_registration_id()
+		streaming = is_true( values.get( 'stream' ) )
+		export_format = self._get_format( values )
+
+		since = self._get_since( values )
 
-		user = User.get_user( username )
 		# Optionally filter by user or registration id.
-		registrations = get_user_registrations( user,
-												registration_id )
-		if not registrations:
+		with time_phase( self.request, PHASE_STORAGE ):
+			registrations = self._get_registrations( username, registration_id )
+		if not registrations and since is None:
 			return hexc.HTTPNotFound( _('There are no registrations') )
 
-		stream = BytesIO()
-		header_row = self._get_header_row()
-		csv_writer = csv.DictWriter( stream, header_row )
-		csv_writer.writeheader()
+		watermark = values.get( 'since' )
+		if since is not None:
+			registrations = [x for x in registrations
+							 if registration_sort_key( x ) > since]
+		if registrations:
+			watermark = encode_cursor( cap_watermark( registration_sort_key( registrations[-1] ) ))
 
-		registrations = sorted( registrations, key=lambda x: x.timestamp )
-		for registration in registrations:
-			line_data = self._get_row_data( registration )
-			if line_data:
-				csv_writer.writerow( line_data )
+		if streaming:
+			# The response is written after the request's transaction ends,
+			# so its rows are built in a transaction of their own.
+			site = getSite()
+			site_names = (site.__name__,) if site is not None else ()
+			until = registration_sort_key( registrations[-1] ) if registrations else (0, 0)
+			chunks = iter_in_transaction( lambda: self._iter_streamed_chunks( export_format,
+																			 username,
+																			 registration_id,
+																			 since,
+																			 until ),
+										  site_names )
+		else:
+			chunks = self._iter_chunks( export_format, registrations )
 
+		content_type, extension = EXPORT_FORMATS[export_format]
 		response = self.request.response
-		response.body = stream.getvalue()
-		response.content_type = str('text/csv; charset=UTF-8')
-		response.content_disposition = b'attachment; filename="registrations.csv"'
+		response.content_type = str( content_type )
+		response.content_disposition = str( 'attachment; filename="registrations.%s"' % extension )
+		if watermark:
+			response.headers[str( WATERMARK_HEADER )] = str( watermark )
+		if streaming:
+			# Rows are encoded lazily, one batch per chunk.
+			response.app_iter = chunks
+			response.content_length = None
+		else:
+			with time_phase( self.request, PHASE_CSV ):
+				response.body = b''.join( chunks )
 		return response
 
 @view_config(route_name='objects.generic.traversal',
@@ -137,20 +322,364 @@ class RegistrationSurveyCSVView( RegistrationCSVView,
 	a CSV.
 	"""
 
-	def _get_header_row(self):
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='POST',
+			 name=REGISTRATION_EXPORT_JOB_VIEW)
+@timed_view
+class StartRegistrationExportView( AbstractAuthenticatedView,
+								   ModeledContentUploadRequestUtilsMixin,
+								   RegistrationIDViewMixin,
+								   RegistrationJobViewMixin ):
+	"""
+	An admin view to build a registration CSV in the background,
+	returning the job to poll with the status and download views. Jobs
+	live in the server process that started them (the job `Owner`), so
+	those requests must be routed to that process.
+
+	params:
+		* registration_id
+		* user - (optional) only export this user's registrations
+		* survey - (optional) include survey data
+	"""
+
+	def __call__(self):
+		values = CaseInsensitiveDict( self.readInput() )
+		username = values.get( 'user' ) or values.get( 'username' )
+		registration_id = self._get_registration_id( values )
+		if is_true( values.get( 'survey' ) ):
+			exporter = RegistrationSurveyExporter( registration_id, username )
+		else:
+			exporter = RegistrationExporter( registration_id, username )
+
+		site = getSite()
+		site_names = (site.__name__,) if site is not None else ()
+		job = self._job_queue.submit( make_export_job( exporter, site_names ),
+									  name='RegistrationExport' )
+		logger.info( 'Registration export queued (%s) (%s)',
+					 registration_id, job.id )
+		self.request.response.status_int = 202
+		return self._job_to_external( job, 'RegistrationExportJob' )
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='GET',
+			 name=REGISTRATION_EXPORT_STATUS_VIEW)
+@timed_view
+class RegistrationExportStatusView( AbstractAuthenticatedView,
+									RegistrationJobViewMixin ):
+	"""
+	An admin view returning the progress of a background export.
+	"""
+
+	def __call__(self):
+		return self._job_to_external( self._get_job(), 'RegistrationExportJob' )
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='GET',
+			 name=REGISTRATION_EXPORT_DOWNLOAD_VIEW)
+@timed_view
+class RegistrationExportDownloadView( AbstractAuthenticatedView,
+									  RegistrationJobViewMixin ):
+	"""
+	An admin view to download the CSV of a finished background export.
+	"""
+
+	def __call__(self):
+		job = self._get_job()
+		if job.state != JOB_SUCCESS:
+			raise hexc.HTTPUnprocessableEntity( _('Export is not finished.') )
+
+		response = self.request.response
+		response.content_type = str('text/csv; charset=UTF-8')
+		response.content_disposition = b'attachment; filename="registrations.csv"'
+		response.app_iter = job.iter_result()
+		response.content_length = None
+		return response
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='POST',
+			 name=REGISTRATION_IMPORT_VIEW)
+@timed_view
+class ImportRegistrationsView( AbstractAuthenticatedView,
+							   ModeledContentUploadRequestUtilsMixin,
+							   RegistrationIDViewMixin,
+							   RegistrationJobViewMixin ):
+	"""
+	An admin view to import registration and survey rows, as a CSV or
+	NDJSON upload. Rows name the `username`, `school`, `grade`, `course`
+	(ntiid), `session` and `employee_id`, and optionally the `phone` and
+	survey `version`; any other column is a survey response.
+
+	Rows are validated against the stored rules up front; the rest are
+	stored in the background, a batch per transaction. Rows that cannot be
+	validated or stored are reported by line, without stopping the import.
+	As with submissions, sessions not in the uploaded sessions are allowed.
+
+	params:
+		* registration_id
+		* format - (optional) csv (default) or ndjson
+		* enroll - (optional) enroll users in their course
+		* batchSize - (optional) the number of rows per transaction
+	"""
+
+	def _get_batch_size(self, values):
+		try:
+			result = int( values.get( 'batchSize' ) or DEFAULT_IMPORT_BATCH_SIZE )
+		except ValueError:
+			raise hexc.HTTPUnprocessableEntity( _('Invalid batch size.') )
+		if result < 1:
+			raise hexc.HTTPUnprocessableEntity( _('Invalid batch size.') )
+		return min( result, MAX_IMPORT_BATCH_SIZE )
+
+	def _iter_records(self, values):
+		source = get_source( self.request, 'input', 'csv', 'ndjson', 'source' )
+		if source is None:
+			raise hexc.HTTPUnprocessableEntity( _('No import file given.') )
+		format_ = (values.get( 'format' ) or FORMAT_CSV).lower()
+		if format_ == FORMAT_NDJSON:
+			return iter_ndjson_records( source )
+		if format_ != FORMAT_CSV:
+			raise hexc.HTTPUnprocessableEntity( _('Unsupported import format.') )
+		return iter_csv_records( source )
+
+	def _get_rows(self, registration_id, values, errors):
+		rule_index = get_rule_index( registration_id )
 		result = []
-		result.extend( self._get_registration_header_row() )
-		result.extend( self._get_registration_survey_header_row() )
+		for line, record in self._iter_records( values ):
+			try:
+				row = parse_import_row( line, record, RegistrationData )
+				validate_import_row( row, rule_index )
+				if User.get_user( row.username ) is None:
+					raise ImportRowError( 'User not found' )
+			except ImportRowError as e:
+				errors.append( {'line': line,
+								'username': record.get( 'username' ),
+								'message': '%s' % e} )
+				continue
+			result.append( row )
 		return result
 
-	def _get_row_data(self, registration):
-		result = {}
-		registration_data = self._get_registration_row_data( registration )
-		if not registration_data:
+	def __call__(self):
+		values = CaseInsensitiveDict( self.readInput() )
+		registration_id = self._get_registration_id( values )
+		batch_size = self._get_batch_size( values )
+		enroll = is_true( values.get( 'enroll' ) )
+
+		errors = []
+		with time_phase( self.request, PHASE_PARSE ):
+			rows = self._get_rows( registration_id, values, errors )
+		if not rows:
+			raise_json_error( self.request,
+							  hexc.HTTPUnprocessableEntity,
+							  {'message': _('No valid rows to import.'),
+							   'code': 'InvalidRegistrationImport',
+							   'Errors': errors},
+							  None )
+
+		site = getSite()
+		site_names = (site.__name__,) if site is not None else ()
+		importer = RegistrationImporter( registration_id, rows, enroll,
+										 batch_size, site_names )
+		job = self._job_queue.submit( importer, name='RegistrationImport' )
+		logger.info( 'Registration import queued (%s) (%s) (rows=%s) (invalid=%s)',
+					 registration_id, job.id, len( rows ), len( errors ) )
+		self.request.response.status_int = 202
+		result = self._job_to_external( job, 'RegistrationImportJob' )
+		result['Errors'] = errors
+		return result
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='GET',
+			 name=REGISTRATION_IMPORT_STATUS_VIEW)
+@timed_view
+class RegistrationImportStatusView( AbstractAuthenticatedView,
+									RegistrationJobViewMixin ):
+	"""
+	An admin view returning the progress of a registration import and,
+	once finished, the rows stored and the row errors.
+	"""
+
+	def __call__(self):
+		job = self._get_job()
+		result = self._job_to_external( job, 'RegistrationImportJob' )
+		if job.state == JOB_SUCCESS:
+			result.update( job.result )
+		return result
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='GET',
+			 name=REGISTRATION_PAGED_READ_VIEW)
+@timed_view
+class RegistrationPageView( AbstractAuthenticatedView,
+							RegistrationIDViewMixin ):
+	"""
+	An admin view to fetch registration data as JSON, a page at a time.
+	Pages are keyed on (timestamp, id) cursors; pass the `Next` cursor of
+	one page as the `after` param to fetch the following page.
+
+	params:
+		* registration_id
+		* user - (optional) only return this user's registrations
+		* batchSize - (optional) the number of registrations per page
+		* after - (optional) the cursor to return registrations after
+	"""
+
+	def _get_batch_size(self, values):
+		try:
+			result = int( values.get( 'batchSize' ) or DEFAULT_PAGE_SIZE )
+		except ValueError:
+			raise hexc.HTTPUnprocessableEntity( _('Invalid batch size.') )
+		if result < 1:
+			raise hexc.HTTPUnprocessableEntity( _('Invalid batch size.') )
+		return min( result, MAX_PAGE_SIZE )
+
+	def _get_after(self, values):
+		cursor = values.get( 'after' )
+		if not cursor:
 			return None
-		result.update( registration_data )
-		survey_data = self._get_registration_survey_row_data( registration )
-		result.update( survey_data )
+		try:
+			return decode_cursor( cursor )
+		except ValueError:
+			raise hexc.HTTPUnprocessableEntity( _('Invalid cursor.') )
+
+	def __call__(self):
+		values = CaseInsensitiveDict( self.request.params )
+		username = values.get( 'user' ) or values.get( 'username' )
+		registration_id = self._get_registration_id()
+		batch_size = self._get_batch_size( values )
+		after = self._get_after( values )
+
+		user = User.get_user( username ) if username else None
+		registrations = get_user_registrations( user, registration_id )
+		# Fetch one extra registration to know whether another page exists.
+		page = registrations_after( registrations or (), after, batch_size + 1 )
+		has_next = len( page ) > batch_size
+		page = page[:batch_size]
+
+		self._resolve_registration_users( page )
+		items = [self._get_registration_row_data( x ) for x in page]
+		items = [x for x in items if x]
+
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationPage'
+		result[ITEMS] = items
+		result[ITEM_COUNT] = len( items )
+		result['BatchSize'] = batch_size
+		result['Next'] = None
+		if has_next:
+			result['Next'] = encode_cursor( registration_sort_key( page[-1] ) )
+		return result
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='GET',
+			 name=REGISTRATION_STATS_VIEW)
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='POST',
+			 name=REGISTRATION_STATS_VIEW)
+@timed_view
+class RegistrationStatisticsView( AbstractAuthenticatedView,
+								  RegistrationIDViewMixin ):
+	"""
+	An admin view returning registration counts, in total and by school,
+	grade, curriculum and session. Counts are maintained as registrations
+	are submitted, updated and removed, once started by uploading the
+	rules or sessions of the registration id. A POST recounts the stored
+	registrations and starts maintaining the counts. GETs never store
+	anything; until counts are maintained, they count the stored
+	registrations on each call.
+
+	params:
+		* registration_id
+	"""
+
+	def _get_counts(self, registration_id):
+		"""
+		Return the counts, and whether they are maintained.
+		"""
+		if self.request.method == 'POST':
+			counters = start_registration_counts( registration_id, rebuild=True )
+			return counters.get_counts( registration_id ), True
+		counts = get_registration_counters().get_counts( registration_id )
+		if counts is not None:
+			return counts, True
+		registrations = get_user_registrations( None, registration_id )
+		return tally_registrations( registrations or () ), False
+
+	def __call__(self):
+		registration_id = self._get_registration_id()
+		with time_phase( self.request, PHASE_STORAGE ):
+			counts, maintained = self._get_counts( registration_id )
+
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationStatistics'
+		result['RegistrationId'] = registration_id
+		result['Maintained'] = maintained
+		result['Total'] = counts.get( TOTAL, {} ).get( '', 0 )
+		for dimension in COUNTED_DIMENSIONS:
+			result[dimension] = counts.get( dimension, {} )
+		return result
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='GET',
+			 name=REGISTRATION_METRICS_VIEW)
+class RegistrationMetricsView( AbstractAuthenticatedView ):
+	"""
+	An admin view returning the registration metrics of this process,
+	such as submission attempts, retries and commits, and the time spent
+	in each phase of each registration view.
+
+	params:
+		* format - (optional) `prometheus` for the Prometheus text format
+	"""
+
+	def _get_timings(self, metrics):
+		result = {}
+		for (view_name, phase), (count, total) in metrics.timings().items():
+			result.setdefault( view_name, {} )[phase] = {'Count': count,
+														 'Total': total}
+		return result
+
+	def __call__(self):
+		metrics = get_registration_metrics()
+		if metrics is None:
+			raise hexc.HTTPNotFound( _('No registration metrics.') )
+		values = CaseInsensitiveDict( self.request.params )
+		if values.get( 'format' ) == 'prometheus':
+			response = self.request.response
+			response.content_type = str( 'text/plain; version=0.0.4' )
+			response.body = to_prometheus( metrics ).encode( 'utf-8' )
+			return response
+
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationMetrics'
+		result[ITEMS] = metrics.snapshot()
+		result['Timings'] = self._get_timings( metrics )
 		return result
 
 @view_config(route_name='objects.generic.traversal',
@@ -159,11 +688,17 @@ class RegistrationSurveyCSVView( RegistrationCSVView,
 			 context=RegistrationPathAdapter,
 			 request_method='POST',
 			 name=REGISTRATION_UPDATE_VIEW)
+@timed_view
 class RegistrationUpdateView(AbstractAuthenticatedView,
 							 RegistrationIDViewMixin,
 							 ModeledContentUploadRequestUtilsMixin):
 	"""
-	An admin view to update registration data, via CSV input.
+	An admin view to update registration data, via CSV input. All
+	registrations are fetched in one query up front; the result summarizes
+	the `Updated`, `Unchanged`, `Skipped` (user not found) and `Missing`
+	(no registration) usernames, along with the field `Changes` per user.
+	Only changed fields are written. With `dry_run`, nothing is written
+	and the computed changes are returned.
 	"""
 
 	@Lazy
@@ -172,37 +707,110 @@ class RegistrationUpdateView(AbstractAuthenticatedView,
 				u'grade', u'session_range', u'curriculum']
 		return keys
 
+	@Lazy
+	def _counters(self):
+		return get_registration_counters()
+
 	def _get_input(self):
 		source = get_source(self.request, 'csv', 'input', 'source')
 		if source is None:
 			raise hexc.HTTPUnprocessableEntity()
 		return source
 
+	def _get_registrations_by_username(self, registration_id):
+		"""
+		Fetch every registration for the registration id in one query,
+		keyed by lowercase username.
+		"""
+		result = {}
+		registrations = get_user_registrations( None, registration_id )
+		for registration in registrations or ():
+			if registration.user:
+				username = registration.user.username.lower()
+				result.setdefault( username, [] ).append( registration )
+		return result
+
+	def _update_registration(self, registration, row, dry_run=False):
+		"""
+		Write the fields of `row` that differ from the registration,
+		returning a dict of field to (old, new) values. Unchanged fields
+		are not written, so as not to dirty the registration.
+		"""
+		changes = {}
+		for key in self._update_keys:
+			if key in row:
+				val = row.get( key )
+				attr = 'grade_teaching' if key == 'grade' else key
+				old_val = getattr( registration, attr, None )
+				if old_val == val:
+					continue
+				changes[key] = (old_val, val)
+				if not dry_run:
+					setattr( registration, attr, val )
+					self._counters.update( self._get_registration_id(),
+										   key, old_val, val )
+		return changes
+
 	def __call__(self):
 		registration_id = self._get_registration_id()
+		params = CaseInsensitiveDict( self.request.params )
+		dry_run = is_true( params.get( 'dry_run' ) )
+
+		with time_phase( self.request, PHASE_PARSE ):
+			csv_input = self._get_input()
+			rows = list( csv.DictReader( csv_input ) )
+		with time_phase( self.request, PHASE_STORAGE ):
+			registrations_by_username = self._get_registrations_by_username( registration_id )
 
-		csv_input = self._get_input()
-		reader = csv.DictReader( csv_input )
-		for row in reader:
+		updated = []
+		skipped = []
+		missing = []
+		unchanged = []
+		diff = {}
+		for row in rows:
 			username = row.get( 'username' )
-			user = User.get_user( username ) if username else None
-			if username and user is None:
-				logger.warn( 'Skipping user not found %s', username )
-				continue
-			registrations = get_user_registrations( user,
-													registration_id )
+			if username:
+				registrations = registrations_by_username.get( username.lower() )
+			else:
+				# No user given, so this row applies to every registration.
+				registrations = [x for y in registrations_by_username.values() for x in y]
+
 			if not registrations:
-				return hexc.HTTPNotFound( _('There are no registrations found for %s' % username) )
+				if username and User.get_user( username ) is None:
+					logger.warn( 'Skipping user not found %s', username )
+					skipped.append( username )
+				else:
+					logger.warn( 'No registrations found for %s', username )
+					missing.append( username )
+				continue
 
+			row_changes = []
 			for registration in registrations:
-				for key in self._update_keys:
-					if key in row:
-						val = row.get( key )
-						if key == 'grade':
-							key = 'grade_teaching'
-						setattr( registration, key, val )
-				logger.info( 'Updated registration data (user=%s) (data=%s)', username, row )
-		return hexc.HTTPNoContent()
+				changes = self._update_registration( registration, row, dry_run )
+				if changes:
+					row_changes.append( changes )
+			if not row_changes:
+				unchanged.append( username )
+				continue
+			updated.append( username )
+			diff.setdefault( username, [] ).extend( row_changes )
+			if not dry_run:
+				logger.info( 'Updated registration data (user=%s) (changes=%s)',
+							 username, row_changes )
+
+		moved = any( 'session_range' in x for y in diff.values() for x in y )
+		if moved and not dry_run:
+			rebuild_session_seats( registration_id )
+
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationUpdateSummary'
+		result['DryRun'] = dry_run
+		result['Updated'] = updated
+		result['Unchanged'] = unchanged
+		result['Skipped'] = skipped
+		result['Missing'] = missing
+		result['Changes'] = diff
+		return result
 
 RegistrationEnrollmentRule = namedtuple( 'RegistrationEnrollmentRule',
 										 ('school',
@@ -215,15 +823,44 @@ RegistrationSessions = namedtuple( 'RegistrationSessions',
 									 'session_range',
 									 'course_ntiid'))
 
+_RegistrationSessionRow = namedtuple( 'RegistrationSessionRow',
+									  RegistrationSessions._fields + ('capacity',))
+
+class RegistrationSessionRow(_RegistrationSessionRow):
+	"""
+	An uploaded session, with an optional seat capacity.
+	"""
+
+	__slots__ = ()
+
+	def __new__(cls, curriculum, session_range, course_ntiid, capacity=None):
+		if capacity is not None:
+			try:
+				capacity = int( capacity )
+			except ValueError:
+				capacity = -1
+			if capacity < 0:
+				raise ValueError( 'Invalid session capacity' )
+		return super(RegistrationSessionRow, cls).__new__( cls, curriculum,
+														   session_range,
+														   course_ntiid,
+														   capacity )
+
+	@property
+	def session(self):
+		return RegistrationSessions( *self[:3] )
+
 @view_config(route_name='objects.generic.traversal',
 			 renderer='rest',
 			 permission=nauth.ACT_NTI_ADMIN,
 			 context=RegistrationPathAdapter,
 			 request_method='POST',
 			 name=REGISTRATION_AVAILABLE_SESSIONS)
+@timed_view
 class RegistrationSessionsPostView(AbstractAuthenticatedView,
 								   ModeledContentUploadRequestUtilsMixin,
-								   RegistrationIDViewMixin):
+								   RegistrationIDViewMixin,
+								   RegistrationCSVUploadMixin):
 	"""
 	An admin view to push registration sessions to server. We expect
 	these columns in the inbound csv:
@@ -231,8 +868,29 @@ class RegistrationSessionsPostView(AbstractAuthenticatedView,
 		* course/curriculum
 		* session_range
 		* course_ntiid
+		* capacity - (optional) the number of seats in the session
+
+	Every invalid row is reported, by line number, in a single 422. With
+	`delta`, the upload is compared against the stored rows and only
+	stored if it differs; the added, removed and unchanged counts are
+	returned.
 	"""
 
+	def _session_key(self, session):
+		return (session.curriculum, session.session_range, session.course_ntiid)
+
+	def _get_capacities(self, session_rows):
+		"""
+		Map (course_ntiid, session_range) to the session capacity; a
+		session listed for several curricula takes the first capacity given.
+		"""
+		result = {}
+		for row in session_rows:
+			key = (row.course_ntiid, row.session_range)
+			if result.get( key ) is None:
+				result[key] = row.capacity
+		return result
+
 	def __call__(self):
 		values = CaseInsensitiveDict(self.readInput())
 		registration_id = self._get_registration_id( values )
@@ -240,24 +898,41 @@ class RegistrationSessionsPostView(AbstractAuthenticatedView,
 		if source is None:
 			raise hexc.HTTPUnprocessableEntity( _('No CSV file found.') )
 
-		session_infos = []
-		csv_input = csv.reader( source )
-		# Skip header
-		next( csv_input, None )
-		for row in csv_input:
-			if not row or row[0].startswith("#") or not ''.join( row ).strip():
-				continue
-			if not (row[0] and row[1] and row[2]):
-				raise hexc.HTTPUnprocessableEntity( 'Line with missing data (%s)' % row )
-			session_info = RegistrationSessions( row[0], row[1], row[2] )
-			session_infos.append( session_info )
+		errors = []
+		with time_phase( self.request, PHASE_PARSE ):
+			session_rows = list( self._iter_upload_rows( source, RegistrationSessionRow,
+														 errors, optional=1 ))
+		if errors:
+			self._raise_upload_errors( errors )
 
-		if not session_infos:
+		if not session_rows:
 			raise hexc.HTTPUnprocessableEntity( _('No session information given.') )
 
-		store_count = store_registration_sessions( registration_id, session_infos )
+		session_infos = [x.session for x in session_rows]
+		capacities = self._get_capacities( session_rows )
+		delta = None
+		if self._is_delta( values ):
+			stored = get_registration_sessions( registration_id ) or ()
+			delta = self._get_upload_delta( (self._session_key( x ) for x in session_infos),
+											(self._session_key( x ) for x in stored) )
+			if not delta['Added'] and not delta['Removed']:
+				if capacities != get_session_seats().get_capacities( registration_id ):
+					rebuild_session_seats( registration_id, capacities )
+					logger.info( 'Registration session capacities stored' )
+				logger.info( 'Registration session rules unchanged (count=%s)',
+							 delta['Unchanged'] )
+				return delta
+
+		with time_phase( self.request, PHASE_STORAGE ):
+			store_count = store_registration_sessions( registration_id, session_infos )
+		invalidate_registration_rules( registration_id )
+		rebuild_session_seats( registration_id, capacities )
+		# Counting starts with the first upload, in a transaction that commits.
+		counters = start_registration_counts( registration_id )
+		counters.prepare( registration_id,
+						  (('session_range', x.session_range) for x in session_infos) )
 		logger.info( 'Registration session rules stored (count=%s)', store_count )
-		return hexc.HTTPCreated()
+		return delta if delta is not None else hexc.HTTPCreated()
 
 @view_config(route_name='objects.generic.traversal',
 			 renderer='rest',
@@ -265,9 +940,11 @@ class RegistrationSessionsPostView(AbstractAuthenticatedView,
 			 context=RegistrationPathAdapter,
 			 request_method='POST',
 			 name=REGISTRATION_ENROLL_RULES)
+@timed_view
 class RegistrationEnrollmentRulesPostView(AbstractAuthenticatedView,
 										  ModeledContentUploadRequestUtilsMixin,
-										  RegistrationIDViewMixin):
+										  RegistrationIDViewMixin,
+										  RegistrationCSVUploadMixin):
 	"""
 	An admin view to push registration rules to server. We expect
 	these columns in the inbound csv:
@@ -276,8 +953,27 @@ class RegistrationEnrollmentRulesPostView(AbstractAuthenticatedView,
 		* course/curriculum
 		* grade
 		* course_ntiid
+
+	Every invalid row is reported, by line number, in a single 422. With
+	`delta`, the upload is compared against the stored rows and only
+	stored if it differs; the added, removed and unchanged counts are
+	returned.
 	"""
 
+	def _iter_counted_values(self, rules):
+		for rule in rules:
+			yield ('school', rule.school)
+			yield ('grade', rule.grade)
+			yield ('curriculum', rule.curriculum)
+
+	def _rule_key(self, rule):
+		# Stored rules name the grade `grade_teaching`.
+		if isinstance( rule, RegistrationEnrollmentRule ):
+			grade = rule.grade
+		else:
+			grade = rule.grade_teaching
+		return (rule.school, rule.curriculum, grade, rule.course_ntiid)
+
 	def __call__(self):
 		values = CaseInsensitiveDict(self.readInput())
 		registration_id = self._get_registration_id( values )
@@ -285,28 +981,33 @@ class RegistrationEnrollmentRulesPostView(AbstractAuthenticatedView,
 		if source is None:
 			raise hexc.HTTPUnprocessableEntity( _('No CSV input given.') )
 
-		rules = []
-		csv_input = csv.reader( source )
-		# Skip header
-		next( csv_input, None )
-		for row in csv_input:
-			if not row or row[0].startswith("#") or not ''.join( row ).strip():
-				continue
-			if not (row[0] and row[1] and row[2] and row[3]):
-				raise hexc.HTTPUnprocessableEntity( 'Line with missing data (%s)' % row )
-			enroll_rule = RegistrationEnrollmentRule( row[0],
-													  row[1],
-													  row[2],
-													  row[3] )
-			rules.append( enroll_rule )
+		errors = []
+		with time_phase( self.request, PHASE_PARSE ):
+			rules = list( self._iter_upload_rows( source, RegistrationEnrollmentRule, errors ))
+		if errors:
+			self._raise_upload_errors( errors )
 
 		if not rules:
 			raise hexc.HTTPUnprocessableEntity( _('No rules given.') )
 
-		store_count = store_registration_rules( registration_id, rules )
+		delta = None
+		if self._is_delta( values ):
+			stored = get_registration_rules( registration_id ) or ()
+			delta = self._get_upload_delta( (self._rule_key( x ) for x in rules),
+											(self._rule_key( x ) for x in stored) )
+			if not delta['Added'] and not delta['Removed']:
+				logger.info( 'Registration enrollment rules unchanged (count=%s)',
+							 delta['Unchanged'] )
+				return delta
+
+		with time_phase( self.request, PHASE_STORAGE ):
+			store_count = store_registration_rules( registration_id, rules )
+		invalidate_registration_rules( registration_id )
+		counters = start_registration_counts( registration_id )
+		counters.prepare( registration_id, self._iter_counted_values( rules ) )
 		logger.info( 'Registration enrollment rules stored (count=%s)',
 					 store_count )
-		return hexc.HTTPCreated()
+		return delta if delta is not None else hexc.HTTPCreated()
 
 @view_config(route_name='objects.generic.traversal',
 			 renderer='rest',
@@ -314,15 +1015,42 @@ class RegistrationEnrollmentRulesPostView(AbstractAuthenticatedView,
 			 context=RegistrationPathAdapter,
 			 request_method='POST',
 			 name='RemoveRegistrations')
+@timed_view
 class RemoveRegistrationsView(AbstractAuthenticatedView,
 							  ModeledContentUploadRequestUtilsMixin,
-							  RegistrationIDViewMixin):
+							  RegistrationIDViewMixin,
+							  RegistrationJobViewMixin):
 	"""
 	Delete the registrations by user and registration id. This should
 	only be used by admins in test environments. By default, users
 	are unenrolled from corresponding course.
+
+	With `batchSize`, and no user, the registrations are deleted in the
+	background, that many users per transaction, for the registration id
+	or (when forced) every registration id. The job is returned, to poll
+	with the removal status view.
 	"""
 
+	def _get_batch_size(self, params):
+		try:
+			result = int( params.get( 'batchSize' ) )
+		except (TypeError, ValueError):
+			raise hexc.HTTPUnprocessableEntity( _('Invalid batch size.') )
+		if result < 1:
+			raise hexc.HTTPUnprocessableEntity( _('Invalid batch size.') )
+		return min( result, MAX_REMOVAL_BATCH_SIZE )
+
+	def _queue_removal(self, registration_id, batch_size, unenroll):
+		site = getSite()
+		site_names = (site.__name__,) if site is not None else ()
+		remover = RegistrationRemover( registration_id, batch_size,
+									   unenroll, site_names )
+		job = self._job_queue.submit( remover, name='RegistrationRemoval' )
+		logger.info( 'Registration removal queued (registration=%s) (%s) (batch=%s)',
+					 registration_id, job.id, batch_size )
+		self.request.response.status_int = 202
+		return self._job_to_external( job, 'RegistrationRemovalJob' )
+
 	def __call__(self):
 		params = CaseInsensitiveDict(self.readInput())
 		username = params.get( 'user' ) or params.get( 'username' )
@@ -337,21 +1065,41 @@ class RemoveRegistrationsView(AbstractAuthenticatedView,
 			raise hexc.HTTPUnprocessableEntity(
 							_('No username or registration id, must force.') )
 
-		deleted = delete_user_registrations( user, registration_id )
+		if params.get( 'batchSize' ) and user is None:
+			return self._queue_removal( registration_id,
+										self._get_batch_size( params ),
+										unenroll )
+
+		with time_phase( self.request, PHASE_STORAGE ):
+			deleted = delete_user_registrations( user, registration_id )
 		logger.info( 'Deleted %s user registrations (user=%s) (registration=%s)',
 					len( deleted ), username, registration_id )
+		uncount_registrations( registration_id, deleted )
 
 		# Now unenroll our users.
 		if unenroll:
-			for registration, course_ntiid in deleted:
-				course = find_object_with_ntiid( course_ntiid )
-				course = ICourseInstance( course, None )
-				if course is not None:
-					manager = ICourseEnrollmentManager( course )
-					manager.drop( registration.user )
-					logger.info( 'User unenrolled (%s) (%s)',
-								 registration.user, course_ntiid )
-				else:
-					logger.warn( 'No course found for (%s) (%s)',
-								 registration.user, course_ntiid )
+			with time_phase( self.request, PHASE_ENROLLMENT ):
+				unenroll_registrations( deleted, get_course_resolver( self.request ) )
 		return hexc.HTTPNoContent()
+
+@view_config(route_name='objects.generic.traversal',
+			 renderer='rest',
+			 permission=nauth.ACT_NTI_ADMIN,
+			 context=RegistrationPathAdapter,
+			 request_method='GET',
+			 name=REGISTRATION_REMOVAL_STATUS_VIEW)
+@timed_view
+class RegistrationRemovalStatusView( AbstractAuthenticatedView,
+									 RegistrationJobViewMixin ):
+	"""
+	An admin view returning the progress of a batched registration
+	removal and, once finished, the users, registrations deleted and
+	users unenrolled, in total and for each batch.
+	"""
+
+	def __call__(self):
+		job = self._get_job()
+		result = self._job_to_external( job, 'RegistrationRemovalJob' )
+		if job.state == JOB_SUCCESS:
+			result.update( job.result )
+		return result
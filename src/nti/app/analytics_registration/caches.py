@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import json
+import time
+import hashlib
+import nameparser
+
+from collections import namedtuple
+from collections import OrderedDict
+
+from threading import Lock
+
+from zope import interface
+
+from nti.app.analytics_registration.interfaces import INameParserCache
+from nti.app.analytics_registration.interfaces import IRegistrationRulesCache
+
+#: The default number of parsed names to keep.
+DEFAULT_NAME_CACHE_SIZE = 10000
+
+def parse_name(realname):
+	human_name = nameparser.HumanName( realname )
+	return human_name.first or '', human_name.last or ''
+
+@interface.implementer(INameParserCache)
+class NameParserCache(object):
+	"""
+	A least-recently-used cache of `nameparser` results, keyed by
+	the realname string.
+	"""
+
+	def __init__(self, maxsize=DEFAULT_NAME_CACHE_SIZE):
+		self.maxsize = maxsize
+		self._lock = Lock()
+		self._data = OrderedDict()
+		self.hits = self.misses = 0
+
+	def __len__(self):
+		return len( self._data )
+
+	def parse(self, realname):
+		with self._lock:
+			result = self._data.pop( realname, None )
+			if result is not None:
+				self.hits += 1
+				# Re-insert as the most recently used.
+				self._data[realname] = result
+				return result
+			self.misses += 1
+
+		result = parse_name( realname )
+		with self._lock:
+			self._data[realname] = result
+			while len( self._data ) > self.maxsize:
+				self._data.popitem( last=False )
+		return result
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.hits = self.misses = 0
+
+#: A cached rules document, with the ETag and modification time (seconds
+#: since the epoch) it is served with, and the stored rules version it was
+#: built from.
+RegistrationRulesEntry = namedtuple( 'RegistrationRulesEntry',
+									 ('document',
+									  'etag',
+									  'last_modified',
+									  'version'))
+
+@interface.implementer(IRegistrationRulesCache)
+class RegistrationRulesCache(object):
+	"""
+	Caches the rules document built from the stored rules and sessions of
+	each registration id. An entry is only returned for the rules version
+	it was built from, so rules stored by any process replace it.
+	"""
+
+	def __init__(self):
+		self._lock = Lock()
+		self._data = {}
+		# When the rules were last stored, for unversioned rules.
+		self._modified = {}
+
+	def _get_etag(self, document):
+		value = json.dumps( document, sort_keys=True )
+		return hashlib.md5( value.encode( 'utf-8' ) ).hexdigest()
+
+	def get(self, registration_id, version=None):
+		entry = self._data.get( registration_id )
+		if entry is not None and entry.version != version:
+			return None
+		return entry
+
+	def set(self, registration_id, document, version=None):
+		with self._lock:
+			last_modified = version
+			if last_modified is None:
+				last_modified = self._modified.setdefault( registration_id, time.time() )
+			entry = RegistrationRulesEntry( document,
+											self._get_etag( document ),
+											last_modified,
+											version )
+			self._data[registration_id] = entry
+		return entry
+
+	def invalidate(self, registration_id):
+		with self._lock:
+			self._data.pop( registration_id, None )
+			self._modified[registration_id] = time.time()
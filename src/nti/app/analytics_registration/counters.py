@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incrementally maintained registration counts.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import six
+
+from BTrees.Length import Length
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.annotation.factory import factory as an_factory
+
+from zope.container.contained import Contained
+
+from nti.analytics_registration.registration import get_user_registrations
+
+from nti.app.analytics_registration.enrollment import get_course_ntiids
+from nti.app.analytics_registration.enrollment import get_registration_course_ntiid
+
+from nti.app.analytics_registration.interfaces import ISessionSeats
+from nti.app.analytics_registration.interfaces import IRegistrationCounters
+
+from nti.app.analytics_registration.rules import get_rule_index
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IDataserverFolder
+
+#: The total registration count dimension.
+TOTAL = 'total'
+
+#: The counted dimension for each registration attribute.
+COUNTED_ATTRIBUTES = (('school', 'school'),
+					  ('grade', 'grade_teaching'),
+					  ('curriculum', 'curriculum'),
+					  ('session_range', 'session_range'))
+
+#: The counted dimensions, as named in exports and update CSVs.
+COUNTED_DIMENSIONS = tuple( x[0] for x in COUNTED_ATTRIBUTES )
+
+def _as_key(value):
+	return six.text_type( value ) if value is not None else ''
+
+def get_counted_values(registration, curriculum=None):
+	"""
+	The (dimension, value) pairs a registration is counted under. Submitted
+	registration data has no curriculum, so it is given instead.
+	"""
+	result = [(TOTAL, '')]
+	for dimension, attr in COUNTED_ATTRIBUTES:
+		value = getattr( registration, attr, None )
+		if attr == 'curriculum' and curriculum is not None:
+			value = curriculum
+		result.append( (dimension, _as_key( value )) )
+	return result
+
+@component.adapter(IDataserverFolder)
+@interface.implementer(IRegistrationCounters)
+class RegistrationCounters(Persistent, Contained):
+	"""
+	Registration counts per registration id, dimension and value. Each
+	count is a :class:`BTrees.Length.Length`, which resolves concurrent
+	changes instead of raising conflict errors.
+
+	Counts for a registration id are only maintained once they have been
+	built by :meth:`reset`, so registrations stored before then are never
+	missed.
+	"""
+
+	def __init__(self):
+		# registration_id -> (dimension, value) -> Length
+		self._counts = OOBTree()
+
+	def _get_counter(self, counts, dimension, value):
+		key = (dimension, value)
+		counter = counts.get( key )
+		if counter is None:
+			counter = counts[key] = Length()
+		return counter
+
+	def tracks(self, registration_id):
+		return registration_id in self._counts
+
+	def registration_ids(self):
+		return tuple( self._counts.keys() )
+
+	def change(self, registration_id, values, delta=1):
+		counts = self._counts.get( registration_id )
+		if counts is None:
+			return
+		for dimension, value in values:
+			self._get_counter( counts, dimension, value ).change( delta )
+
+	def prepare(self, registration_id, values):
+		# Adding keys to a BTree conflicts with concurrent adds in the same
+		# bucket; changing an existing Length does not.
+		counts = self._counts.get( registration_id )
+		if counts is None:
+			return
+		for dimension, value in values:
+			self._get_counter( counts, dimension, _as_key( value ) )
+
+	def add(self, registration_id, registration):
+		self.change( registration_id, get_counted_values( registration ), 1 )
+
+	def remove(self, registration_id, registration):
+		self.change( registration_id, get_counted_values( registration ), -1 )
+
+	def update(self, registration_id, dimension, old_value, new_value):
+		if dimension in COUNTED_DIMENSIONS:
+			self.change( registration_id,
+						 ((dimension, _as_key( old_value )),), -1 )
+			self.change( registration_id,
+						 ((dimension, _as_key( new_value )),), 1 )
+
+	def reset(self, registration_id, registrations=()):
+		self._counts[registration_id] = OOBTree()
+		for registration in registrations:
+			self.add( registration_id, registration )
+
+	def clear(self):
+		self._counts.clear()
+
+	def get_counts(self, registration_id):
+		counts = self._counts.get( registration_id )
+		if counts is None:
+			return None
+		result = {}
+		for (dimension, value), counter in counts.items():
+			count = counter()
+			if count > 0:
+				result.setdefault( dimension, {} )[value] = count
+		return result
+
+RegistrationCountersFactory = an_factory( RegistrationCounters,
+										  'nti.app.analytics_registration.counters' )
+
+def get_registration_counters():
+	dataserver = component.getUtility( IDataserver )
+	return IRegistrationCounters( dataserver.dataserver_folder )
+
+def tally_registrations(registrations):
+	"""
+	Count the given registrations without storing anything, returning a
+	dict of dimension to value to count, as with
+	:meth:`RegistrationCounters.get_counts`.
+	"""
+	result = {}
+	for registration in registrations:
+		for dimension, value in get_counted_values( registration ):
+			counts = result.setdefault( dimension, {} )
+			counts[value] = counts.get( value, 0 ) + 1
+	return result
+
+def start_registration_counts(registration_id, rebuild=False):
+	"""
+	Start maintaining the counts of the registration id, counting its
+	stored registrations, unless they are already maintained. Counts must
+	be started in a transaction that commits, such as an upload.
+	"""
+	counters = get_registration_counters()
+	if rebuild or not counters.tracks( registration_id ):
+		registrations = get_user_registrations( None, registration_id )
+		counters.reset( registration_id, registrations or () )
+		logger.info( 'Built registration counts (%s) (count=%s)',
+					 registration_id, len( registrations or () ) )
+	return counters
+
+@component.adapter(IDataserverFolder)
+@interface.implementer(ISessionSeats)
+class SessionSeats(Persistent, Contained):
+	"""
+	Seats taken per registration id and (course_ntiid, session_range),
+	each a :class:`BTrees.Length.Length` so concurrent registrations do
+	not conflict, along with the capacity of each session. Capacities only
+	change on upload, so they are kept in plain BTrees; sessions without
+	a capacity map to None.
+	"""
+
+	def __init__(self):
+		# registration_id -> (course_ntiid, session_range) -> Length
+		self._taken = OOBTree()
+		# registration_id -> (course_ntiid, session_range) -> capacity
+		self._capacities = OOBTree()
+
+	def tracks(self, registration_id):
+		return registration_id in self._taken
+
+	def registration_ids(self):
+		return tuple( self._taken.keys() )
+
+	def take(self, registration_id, course_ntiid, session_range, delta=1):
+		taken = self._taken.get( registration_id )
+		if taken is None:
+			return
+		key = (course_ntiid, session_range)
+		counter = taken.get( key )
+		if counter is None:
+			# Not an uploaded session; count it anyway.
+			counter = taken[key] = Length()
+		counter.change( delta )
+
+	def reset(self, registration_id, capacities, taken=()):
+		counters = OOBTree()
+		# Create every counter up front, so registrations only change them.
+		for key in capacities:
+			counters[key] = Length()
+		for key in taken:
+			counter = counters.get( key )
+			if counter is None:
+				counter = counters[key] = Length()
+			counter.change( 1 )
+		self._taken[registration_id] = counters
+		self._capacities[registration_id] = OOBTree( capacities )
+
+	def _get_remaining(self, registration_id, key, capacity):
+		counter = self._taken[registration_id].get( key )
+		return max( capacity - (counter() if counter is not None else 0), 0 )
+
+	def is_full(self, registration_id, course_ntiid, session_range):
+		capacities = self._capacities.get( registration_id )
+		key = (course_ntiid, session_range)
+		capacity = capacities.get( key ) if capacities is not None else None
+		if capacity is None:
+			return False
+		return not self._get_remaining( registration_id, key, capacity )
+
+	def get_capacities(self, registration_id):
+		return dict( self._capacities.get( registration_id ) or {} )
+
+	def get_remaining(self, registration_id):
+		result = {}
+		capacities = self._capacities.get( registration_id ) or {}
+		for key, capacity in capacities.items():
+			if capacity is None:
+				continue
+			course_ntiid, session_range = key
+			remaining = self._get_remaining( registration_id, key, capacity )
+			result.setdefault( course_ntiid, {} )[session_range] = remaining
+		return result
+
+SessionSeatsFactory = an_factory( SessionSeats,
+								  'nti.app.analytics_registration.seats' )
+
+def get_session_seats():
+	dataserver = component.getUtility( IDataserver )
+	return ISessionSeats( dataserver.dataserver_folder )
+
+def iter_taken_seats(registration_id):
+	"""
+	Yield the (course_ntiid, session_range) of each stored registration,
+	mapping registrations to their course through the enrollment rules.
+	"""
+	course_ntiids = get_course_ntiids( registration_id )
+	for registration in get_user_registrations( None, registration_id ) or ():
+		course_ntiid = get_registration_course_ntiid( registration, course_ntiids )
+		if course_ntiid is not None:
+			yield (course_ntiid, registration.session_range)
+
+def rebuild_session_seats(registration_id, capacities=None):
+	"""
+	Recount the seats of the registration id from the stored
+	registrations, keeping the current capacities unless given.
+	"""
+	seats = get_session_seats()
+	if capacities is None:
+		if not seats.tracks( registration_id ):
+			return
+		capacities = seats.get_capacities( registration_id )
+	seats.reset( registration_id, capacities, iter_taken_seats( registration_id ) )
+
+def count_registration(registration_id, data):
+	"""
+	Count the registration data just stored, and take its seat. It is
+	counted under the curriculum its rule maps it to, as it was stored.
+	"""
+	counters = get_registration_counters()
+	if counters.tracks( registration_id ):
+		rule_index = get_rule_index( registration_id )
+		curriculum = rule_index.get_curriculum( data.school, data.grade_teaching,
+												data.course_ntiid )
+		counters.change( registration_id, get_counted_values( data, curriculum ), 1 )
+	get_session_seats().take( registration_id, data.course_ntiid, data.session_range )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Course NTIID resolution for registration views, cached per request and,
+optionally, across requests.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import time
+
+from collections import namedtuple
+
+from threading import Lock
+
+import transaction
+
+from zope import component
+from zope import interface
+
+from nti.app.analytics_registration.interfaces import ICourseLookupCache
+
+from nti.contenttypes.courses.interfaces import ICourseInstance
+from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
+from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
+
+from nti.dataserver.interfaces import IDataserver
+
+from nti.ntiids.ntiids import find_object_with_ntiid
+
+#: The default number of seconds a course lookup is kept across requests.
+COURSE_LOOKUP_TTL = 5 * 60
+
+#: The request environ key of the per-request course resolver.
+COURSE_RESOLVER_KEY = 'nti.app.analytics_registration.course_resolver'
+
+CourseLookup = namedtuple( 'CourseLookup', ('course', 'entry', 'manager') )
+
+def find_course(course_ntiid):
+	course = find_object_with_ntiid( course_ntiid ) if course_ntiid else None
+	return ICourseInstance( course, None )
+
+def _get_connection():
+	dataserver = component.queryUtility( IDataserver )
+	folder = getattr( dataserver, 'dataserver_folder', None )
+	return getattr( folder, '_p_jar', None )
+
+@interface.implementer(ICourseLookupCache)
+class CourseLookupCache(object):
+	"""
+	Maps course NTIIDs to the (database name, oid) of the course for a
+	limited time. Persistent courses belong to a single connection, so
+	only their identity is kept and courses are loaded from the current
+	connection on each hit.
+	"""
+
+	def __init__(self, ttl=COURSE_LOOKUP_TTL):
+		self.ttl = ttl
+		self._lock = Lock()
+		self._data = {}
+
+	def get(self, course_ntiid, connection):
+		with self._lock:
+			item = self._data.get( course_ntiid )
+		if item is None:
+			return None
+		(database_name, oid), expires = item
+		if expires < time.time():
+			self.invalidate( course_ntiid )
+			return None
+		try:
+			return connection.get_connection( database_name ).get( oid )
+		except KeyError:
+			# Includes POSKeyError, for removed courses.
+			self.invalidate( course_ntiid )
+			return None
+
+	def set(self, course_ntiid, course):
+		jar = getattr( course, '_p_jar', None )
+		oid = getattr( course, '_p_oid', None )
+		if jar is None or oid is None:
+			return
+		key = (jar.db().database_name, oid)
+		with self._lock:
+			self._data[course_ntiid] = (key, time.time() + self.ttl)
+
+	def invalidate(self, course_ntiid=None):
+		with self._lock:
+			if course_ntiid is None:
+				self._data.clear()
+			else:
+				self._data.pop( course_ntiid, None )
+
+class CourseResolver(object):
+	"""
+	Resolves each course NTIID to a :class:`CourseLookup` of the course,
+	its catalog entry and its enrollment manager once. Courses are first
+	looked up in the :class:`ICourseLookupCache` utility, if registered.
+	"""
+
+	def __init__(self):
+		self._lookups = {}
+		self._cache = component.queryUtility( ICourseLookupCache )
+
+	def _find_course(self, course_ntiid):
+		course = None
+		connection = _get_connection() if self._cache is not None else None
+		if connection is not None:
+			course = ICourseInstance( self._cache.get( course_ntiid, connection ), None )
+		if course is None:
+			course = find_course( course_ntiid )
+			if course is not None and self._cache is not None:
+				self._cache.set( course_ntiid, course )
+		return course
+
+	def resolve(self, course_ntiid):
+		"""
+		Return the :class:`CourseLookup` of the course, or None if the
+		course is not found.
+		"""
+		try:
+			return self._lookups[course_ntiid]
+		except KeyError:
+			pass
+		result = None
+		course = self._find_course( course_ntiid ) if course_ntiid else None
+		if course is not None:
+			result = CourseLookup( course,
+								   ICourseCatalogEntry( course, None ),
+								   ICourseEnrollmentManager( course ) )
+		self._lookups[course_ntiid] = result
+		return result
+
+def get_course_resolver(request=None):
+	"""
+	Return the course resolver of the request, or a new resolver without
+	one. A retried request runs in a new transaction and gets a new
+	resolver, so courses from an aborted transaction are not reused.
+	"""
+	if request is None:
+		return CourseResolver()
+	current = transaction.get()
+	scoped = request.environ.get( COURSE_RESOLVER_KEY )
+	if scoped is None or scoped[0] is not current:
+		scoped = request.environ[COURSE_RESOLVER_KEY] = (current, CourseResolver())
+	return scoped[1]
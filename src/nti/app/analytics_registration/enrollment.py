@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Course enrollment of registered users, in the request or deferred to the
+local job queue.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import transaction
+
+from BTrees.OOBTree import OOBTree
+
+from zope import component
+
+from zope.annotation.interfaces import IAnnotations
+
+from nti.analytics_registration.registration import get_registration_rules
+
+from nti.app.analytics_registration.courses import get_course_resolver
+
+from nti.app.analytics_registration.interfaces import IRegistrationJobQueue
+
+from nti.contenttypes.courses.interfaces import ES_CREDIT_NONDEGREE
+
+from nti.contenttypes.courses.interfaces import ICourseEnrollments
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.dataserver.users import User
+
+#: The annotation key of the deferred enrollments of a user.
+DEFERRED_ENROLLMENTS_KEY = 'nti.app.analytics_registration.deferred'
+
+#: The state of a registered user no longer enrolled in their course,
+#: with no deferred enrollment to run.
+ENROLLMENT_DROPPED = 'Dropped'
+
+class CourseNotFoundError(ValueError):
+	"""
+	The course of a registration could not be found.
+	"""
+
+def get_course_ntiids(registration_id):
+	"""
+	Map (school, grade, curriculum) to the course NTIID of the enrollment
+	rules of the registration id.
+	"""
+	result = {}
+	for rule in get_registration_rules( registration_id ) or ():
+		key = (rule.school, rule.grade_teaching, rule.curriculum)
+		result[key] = rule.course_ntiid
+	return result
+
+def get_registration_course_ntiid(registration, course_ntiids):
+	key = (registration.school, registration.grade_teaching, registration.curriculum)
+	return course_ntiids.get( key )
+
+def enroll_in_course(user, lookup):
+	"""
+	Enroll the user in the course of the :class:`CourseLookup`, returning
+	the enrollment record. A user already enrolled keeps the existing
+	record, so retries are safe.
+	"""
+	record = ICourseEnrollments( lookup.course ).get_enrollment_for_principal( user )
+	if record is not None:
+		return record
+	# XXX: We do not have an comparable scope for this type
+	# of enrollment, CREDIT_NONDEGREE is an approximation.
+	record = lookup.manager.enroll( user, scope=ES_CREDIT_NONDEGREE )
+
+	entry_ntiid = lookup.entry.ntiid if lookup.entry is not None else ''
+	logger.info( 'User enrolled in course during registration (%s) (%s)',
+				 user, entry_ntiid )
+	return record
+
+def is_enrolled(user, course_ntiid, resolver=None):
+	resolver = resolver if resolver is not None else get_course_resolver()
+	lookup = resolver.resolve( course_ntiid )
+	if lookup is None:
+		return False
+	record = ICourseEnrollments( lookup.course ).get_enrollment_for_principal( user )
+	return record is not None
+
+def get_enrollment_job_id(username, registration_id):
+	return 'RegistrationEnrollment:%s:%s' % (username.lower(), registration_id)
+
+def mark_deferred_enrollment(user, registration_id, course_ntiid):
+	"""
+	Note the user's enrollment in the course was deferred, until it runs.
+	Kept on the user, so submissions of different users do not conflict.
+	"""
+	annotations = IAnnotations( user )
+	deferred = annotations.get( DEFERRED_ENROLLMENTS_KEY )
+	if deferred is None:
+		deferred = annotations[DEFERRED_ENROLLMENTS_KEY] = OOBTree()
+	deferred[registration_id] = course_ntiid
+
+def get_deferred_enrollment(user, registration_id):
+	"""
+	Return the course NTIID of the user's deferred enrollment not yet
+	run, or None.
+	"""
+	deferred = IAnnotations( user ).get( DEFERRED_ENROLLMENTS_KEY )
+	return deferred.get( registration_id ) if deferred is not None else None
+
+def clear_deferred_enrollment(user, registration_id):
+	deferred = IAnnotations( user ).get( DEFERRED_ENROLLMENTS_KEY )
+	if deferred is not None and registration_id in deferred:
+		del deferred[registration_id]
+
+def make_enrollment_job(username, registration_id, course_ntiid, site_names=()):
+	"""
+	Return a job function enrolling the user in the course in its own
+	transaction, clearing their deferred enrollment.
+	"""
+	def _enroll():
+		user = User.get_user( username )
+		lookup = get_course_resolver().resolve( course_ntiid )
+		if user is None or lookup is None:
+			raise CourseNotFoundError( 'Course not found during registration (%s) (%s)'
+									   % (username, course_ntiid) )
+		enroll_in_course( user, lookup )
+		clear_deferred_enrollment( user, registration_id )
+
+	def _job(job):
+		job.total = 1
+		runner = component.getUtility( IDataserverTransactionRunner )
+		runner( _enroll, site_names=site_names )
+		job.done = 1
+		job.result = course_ntiid
+	return _job
+
+def submit_enrollment(username, registration_id, course_ntiid, site_names=()):
+	"""
+	Queue the enrollment of the user now, returning the job. The unfinished
+	job of an earlier submission is returned instead.
+	"""
+	queue = component.getUtility( IRegistrationJobQueue )
+	return queue.submit( make_enrollment_job( username, registration_id,
+											  course_ntiid, site_names ),
+						 name='RegistrationEnrollment',
+						 job_id=get_enrollment_job_id( username, registration_id ) )
+
+def queue_enrollment(username, registration_id, course_ntiid, site_names=()):
+	"""
+	Queue the enrollment of the user once the current transaction commits,
+	so the job sees the stored registration. Returns the job id.
+	"""
+	def _after_commit(success):
+		if success:
+			submit_enrollment( username, registration_id, course_ntiid, site_names )
+	transaction.get().addAfterCommitHook( _after_commit )
+	return get_enrollment_job_id( username, registration_id )
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registration exports that run outside of a request, or outside of its
+transaction.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+from tempfile import SpooledTemporaryFile
+
+from threading import Event
+from threading import Thread
+
+from six.moves.queue import Full
+from six.moves.queue import Queue
+
+from zope import component
+
+from nti.app.analytics_registration.view_mixins import RegistrationCSVMixin
+from nti.app.analytics_registration.view_mixins import RegistrationIDViewMixin
+from nti.app.analytics_registration.view_mixins import RegistrationSurveyCSVMixin
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+#: Exports larger than this many bytes are spooled to disk.
+EXPORT_SPOOL_SIZE = 5 * 1024 * 1024
+
+#: The number of chunks a streamed export may build ahead of the client.
+STREAM_QUEUE_SIZE = 4
+
+#: The seconds a streamed export waits on a slow client before checking
+#: whether it went away.
+STREAM_PUT_TIMEOUT = 1
+
+class RegistrationExporter(RegistrationCSVMixin,
+						   RegistrationIDViewMixin):
+	"""
+	Builds the registration CSV for a registration id, without a request.
+	"""
+
+	request = None
+
+	def __init__(self, registration_id, username=None):
+		self.registration_id = registration_id
+		self.username = username
+
+	def _get_registration_id(self, *unused_args, **unused_kwargs):
+		return self.registration_id
+
+	def _iter_counted(self, registrations, job):
+		for registration in registrations:
+			yield registration
+			job.done += 1
+
+	def write(self, stream, job):
+		"""
+		Write the CSV to `stream`, reporting progress on `job`.
+		"""
+		registrations = self._get_registrations( self.username,
+												 self.registration_id )
+		job.total = len( registrations )
+		registrations = self._iter_counted( registrations, job )
+		rows = self._iter_row_data( registrations )
+		for chunk in self._iter_csv( self._get_header_row(), rows ):
+			stream.write( chunk )
+
+class RegistrationSurveyExporter(RegistrationSurveyCSVMixin,
+								 RegistrationExporter):
+	"""
+	Builds the registration and survey CSV for a registration id, without
+	a request.
+	"""
+
+def make_export_job(exporter, site_names=()):
+	"""
+	Return a job function that writes the export to a spooled temporary
+	file in its own transaction, leaving the file as the job result.
+	"""
+	def _export(job):
+		stream = SpooledTemporaryFile( max_size=EXPORT_SPOOL_SIZE )
+
+		def _write():
+			# Start over if the runner retries us.
+			stream.seek( 0 )
+			stream.truncate()
+			job.done = 0
+			exporter.write( stream, job )
+
+		runner = component.getUtility( IDataserverTransactionRunner )
+		try:
+			runner( _write, site_names=site_names, side_effect_free=True )
+		except Exception:
+			stream.close()
+			raise
+		job.result = stream
+		logger.info( 'Registration export finished (%s) (rows=%s)',
+					 exporter.registration_id, job.done )
+	return _export
+
+def iter_in_transaction(iter_chunks, site_names=(), queue_size=STREAM_QUEUE_SIZE):
+	"""
+	Yield the chunks of `iter_chunks()`, called on a worker thread in its
+	own read-only transaction, once iteration starts. This lets a streamed
+	response build its rows as it is written, after the request's
+	transaction has ended. At most `queue_size` chunks are built ahead of
+	the client; building stops if the client goes away.
+	"""
+	chunks = Queue( maxsize=queue_size )
+	stop = Event()
+
+	def _put(item):
+		while not stop.is_set():
+			try:
+				chunks.put( item, timeout=STREAM_PUT_TIMEOUT )
+				return True
+			except Full:
+				pass
+		return False
+
+	def _build():
+		for chunk in iter_chunks():
+			if not _put( (chunk, None) ):
+				break
+
+	def _work():
+		runner = component.getUtility( IDataserverTransactionRunner )
+		try:
+			runner( _build, site_names=site_names, side_effect_free=True )
+		except Exception as e:
+			logger.exception( 'Streamed registration export failed' )
+			_put( (None, e) )
+		else:
+			_put( (None, None) )
+
+	thread = Thread( target=_work, name='RegistrationExportStream' )
+	thread.daemon = True
+	thread.start()
+	try:
+		while True:
+			chunk, error = chunks.get()
+			if error is not None:
+				raise error
+			if chunk is None:
+				break
+			yield chunk
+	finally:
+		stop.set()
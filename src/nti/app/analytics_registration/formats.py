@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+NDJSON and Arrow/Parquet encodings of registration export records.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import json
+
+from datetime import datetime
+
+from io import BytesIO
+
+from tempfile import SpooledTemporaryFile
+
+import six
+
+try:
+	import pyarrow
+	import pyarrow.parquet as pyarrow_parquet
+except ImportError: # pragma: no cover
+	pyarrow = pyarrow_parquet = None
+
+from nti.app.analytics_registration.view_mixins import batched
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMAT_ARROW = 'arrow'
+FORMAT_PARQUET = 'parquet'
+
+#: The content type and file extension of each export format.
+EXPORT_FORMATS = {
+	FORMAT_CSV: ('text/csv; charset=UTF-8', 'csv'),
+	FORMAT_NDJSON: ('application/x-ndjson; charset=UTF-8', 'ndjson'),
+	FORMAT_ARROW: ('application/vnd.apache.arrow.stream', 'arrow'),
+	FORMAT_PARQUET: ('application/vnd.apache.parquet', 'parquet'),
+}
+
+#: Registration columns holding timestamps.
+TIMESTAMP_COLUMNS = ('account_create_date', 'last_login_time', 'registration_date')
+
+#: Parquet exports larger than this many bytes are spooled to disk.
+PARQUET_SPOOL_SIZE = 5 * 1024 * 1024
+
+def has_arrow():
+	return pyarrow is not None
+
+def as_datetime(value):
+	"""
+	Normalize the timestamps we export (datetimes, or float seconds since
+	the epoch, as with `lastLoginTime`) to naive UTC datetimes.
+	"""
+	if not value:
+		return None
+	if isinstance( value, datetime ):
+		return value
+	return datetime.utcfromtimestamp( value )
+
+def normalize_record(record):
+	"""
+	Convert the timestamp columns of an export record to datetimes.
+	"""
+	for column in TIMESTAMP_COLUMNS:
+		if column in record:
+			record[column] = as_datetime( record[column] )
+	return record
+
+def _json_default(value):
+	if isinstance( value, datetime ):
+		return value.isoformat()
+	return six.text_type( value )
+
+def iter_ndjson(records):
+	"""
+	Yield the records as newline-delimited JSON, a batch per chunk.
+	"""
+	for batch in batched( records ):
+		lines = [json.dumps( x, default=_json_default ) for x in batch]
+		lines.append( '' )
+		yield '\n'.join( lines ).encode( 'utf-8' )
+
+def arrow_schema(registration_columns, survey_columns=(), list_columns=()):
+	"""
+	The Arrow schema of export records: timestamp registration columns,
+	list<string> survey columns for questions answered with lists (see
+	:mod:`.questions`), and string columns otherwise.
+	"""
+	fields = []
+	for column in registration_columns:
+		if column in TIMESTAMP_COLUMNS:
+			fields.append( pyarrow.field( column, pyarrow.timestamp( 'us' ) ) )
+		else:
+			fields.append( pyarrow.field( column, pyarrow.string() ) )
+	if survey_columns:
+		fields.append( pyarrow.field( 'survey_version', pyarrow.string() ) )
+		for column in survey_columns:
+			if column in list_columns:
+				fields.append( pyarrow.field( column, pyarrow.list_( pyarrow.string() ) ) )
+			else:
+				fields.append( pyarrow.field( column, pyarrow.string() ) )
+	return pyarrow.schema( fields )
+
+def _as_text(value):
+	if value is None or value == '':
+		return None
+	if isinstance( value, (list, tuple) ):
+		# As in CSV exports.
+		return ', '.join( six.text_type( x ) for x in value )
+	return six.text_type( value )
+
+def _as_text_list(value):
+	if value is None or value == '':
+		return None
+	if not isinstance( value, (list, tuple) ):
+		value = [value]
+	return [six.text_type( x ) for x in value]
+
+def _iter_tables(records, schema):
+	for batch in batched( records ):
+		columns = {}
+		for field in schema:
+			name = field.name
+			values = [x.get( name ) for x in batch]
+			if pyarrow.types.is_timestamp( field.type ):
+				values = [as_datetime( x ) for x in values]
+			elif pyarrow.types.is_list( field.type ):
+				values = [_as_text_list( x ) for x in values]
+			else:
+				values = [_as_text( x ) for x in values]
+			columns[name] = values
+		yield pyarrow.Table.from_pydict( columns, schema=schema )
+
+def _drain(stream):
+	result = stream.getvalue()
+	stream.seek( 0 )
+	stream.truncate()
+	return result
+
+def iter_arrow(records, schema):
+	"""
+	Yield the records as an Arrow IPC stream, a record batch per chunk.
+	"""
+	stream = BytesIO()
+	writer = pyarrow.RecordBatchStreamWriter( stream, schema )
+	yield _drain( stream )
+	for table in _iter_tables( records, schema ):
+		writer.write_table( table )
+		yield _drain( stream )
+	writer.close()
+	yield _drain( stream )
+
+def iter_parquet(records, schema, chunk_size=64 * 1024):
+	"""
+	Write the records to a Parquet file, a row group per batch, and
+	yield its contents. Parquet writes its footer last, so the file is
+	built (and spooled) before anything is yielded.
+	"""
+	stream = SpooledTemporaryFile( max_size=PARQUET_SPOOL_SIZE )
+	try:
+		writer = pyarrow_parquet.ParquetWriter( stream, schema )
+		for table in _iter_tables( records, schema ):
+			writer.write_table( table )
+		writer.close()
+		stream.seek( 0 )
+		while True:
+			data = stream.read( chunk_size )
+			if not data:
+				break
+			yield data
+	finally:
+		stream.close()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk import of registration and survey rows.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import csv
+import json
+
+from collections import namedtuple
+
+from datetime import datetime
+
+from zope import component
+
+from nti.analytics_registration.exceptions import NoUserRegistrationException
+from nti.analytics_registration.exceptions import InvalidCourseMappingException
+from nti.analytics_registration.exceptions import DuplicateUserRegistrationException
+from nti.analytics_registration.exceptions import DuplicateRegistrationSurveyException
+
+from nti.analytics_registration.registration import store_registration_data
+from nti.analytics_registration.registration import store_registration_survey_data
+
+from nti.app.analytics_registration.counters import get_session_seats
+from nti.app.analytics_registration.counters import count_registration
+
+from nti.app.analytics_registration.courses import get_course_resolver
+
+from nti.app.analytics_registration.enrollment import enroll_in_course
+
+from nti.app.analytics_registration.questions import note_survey_answers
+
+from nti.app.analytics_registration.view_mixins import batched
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.dataserver.users import User
+
+#: The number of rows stored per transaction by default.
+DEFAULT_IMPORT_BATCH_SIZE = 100
+
+#: The largest number of rows stored per transaction.
+MAX_IMPORT_BATCH_SIZE = 1000
+
+#: Import columns that are not survey responses.
+REGISTRATION_COLUMNS = ('username', 'school', 'grade', 'course', 'session',
+						'employee_id', 'phone', 'version', 'survey_version')
+
+ImportRow = namedtuple( 'ImportRow',
+						('line',
+						 'username',
+						 'data',
+						 'version',
+						 'survey') )
+
+#: The storage errors reported by row, rather than failing the import.
+STORE_ERRORS = (NoUserRegistrationException,
+				InvalidCourseMappingException,
+				DuplicateUserRegistrationException,
+				DuplicateRegistrationSurveyException)
+
+class ImportRowError(ValueError):
+	"""
+	A row that cannot be imported.
+	"""
+
+def iter_csv_records(source):
+	"""
+	Yield (line, record) for each row of a CSV source with a header.
+	"""
+	reader = csv.DictReader( source )
+	for record in reader:
+		if any( record.values() ):
+			yield reader.line_num, record
+
+def iter_ndjson_records(source):
+	"""
+	Yield (line, record) for each object of a newline-delimited JSON source.
+	"""
+	for line, text in enumerate( source, 1 ):
+		if isinstance( text, bytes ):
+			text = text.decode( 'utf-8' )
+		if not text.strip():
+			continue
+		try:
+			record = json.loads( text )
+		except ValueError:
+			record = None
+		if not isinstance( record, dict ):
+			record = {'__invalid__': text}
+		yield line, record
+
+def parse_import_row(line, record, data_factory):
+	"""
+	Return the :class:`ImportRow` of a record. Any column that is not a
+	registration column is a survey response.
+	"""
+	if '__invalid__' in record:
+		raise ImportRowError( 'Invalid JSON' )
+	record = dict( record )
+	values = {}
+	for column in REGISTRATION_COLUMNS:
+		values[column] = record.pop( column, None )
+	missing = [x for x in ('username', 'school', 'grade', 'course', 'session', 'employee_id')
+			   if values[x] in (None, '')]
+	if missing:
+		raise ImportRowError( 'Missing registration value (%s)' % ', '.join( missing ) )
+	data = data_factory( values['school'],
+						 values['grade'],
+						 values['course'],
+						 values['employee_id'],
+						 values['phone'] or None,
+						 values['session'] )
+	survey = dict( (k, v) for k, v in record.items() if v not in (None, '') )
+	return ImportRow( line,
+					  values['username'],
+					  data,
+					  values['version'] or values['survey_version'] or None,
+					  survey )
+
+def validate_import_row(row, rule_index):
+	"""
+	Check the course choice of the row against the rules. As with
+	submissions, sessions not in the uploaded sessions are allowed.
+	"""
+	if not rule_index.is_valid_course( row.data.school,
+									   row.data.grade_teaching,
+									   row.data.course_ntiid ):
+		raise ImportRowError( 'Course given is invalid for this registration info' )
+	if not rule_index.is_valid_session( row.data.course_ntiid,
+										row.data.session_range ):
+		logger.info( 'Import session not in uploaded sessions (line=%s) (%s) (%s)',
+					 row.line, row.data.course_ntiid, row.data.session_range )
+
+def _row_error(row, message):
+	return {'line': row.line,
+			'username': row.username,
+			'message': message}
+
+class RegistrationImporter(object):
+	"""
+	Stores import rows in batches, each in its own transaction. Rows are
+	checked before anything of theirs is written, so a rejected row is
+	reported and the rest of the batch is stored. If storing a row fails,
+	the batch is rolled back and retried a row per transaction, reporting
+	only the failing rows. Optionally enrolls each user in their course.
+	"""
+
+	def __init__(self, registration_id, rows, enroll=False,
+				 batch_size=DEFAULT_IMPORT_BATCH_SIZE, site_names=()):
+		self.registration_id = registration_id
+		self.rows = rows
+		self.enroll = enroll
+		self.batch_size = batch_size
+		self.site_names = site_names
+
+	def _check_row(self, row, resolver):
+		"""
+		Return the user and course lookup (if enrolling) of the row, or
+		raise an :class:`ImportRowError`, before anything is written.
+		"""
+		user = User.get_user( row.username )
+		if user is None:
+			raise ImportRowError( 'User not found' )
+		data = row.data
+		if get_session_seats().is_full( self.registration_id,
+										data.course_ntiid,
+										data.session_range ):
+			raise ImportRowError( 'Session is full' )
+		lookup = None
+		if self.enroll:
+			lookup = resolver.resolve( data.course_ntiid )
+			if lookup is None:
+				raise ImportRowError( 'Course not found' )
+		return user, lookup
+
+	def _store_row(self, row, user, lookup):
+		data = row.data
+		registration_id = self.registration_id
+		timestamp = datetime.utcnow()
+		store_registration_data( user, timestamp, registration_id, data )
+		count_registration( registration_id, data )
+		store_registration_survey_data( user, timestamp, registration_id,
+										row.version, row.survey )
+		note_survey_answers( registration_id, row.survey )
+		if lookup is not None:
+			enroll_in_course( user, lookup )
+
+	def store_batch(self, rows):
+		"""
+		Store the rows in the current transaction, returning the number
+		stored and the errors of the rows rejected. Storage errors are
+		raised, aborting the transaction.
+		"""
+		stored = 0
+		errors = []
+		resolver = get_course_resolver()
+		for row in rows:
+			try:
+				user, lookup = self._check_row( row, resolver )
+			except ImportRowError as e:
+				errors.append( _row_error( row, '%s' % e ))
+				continue
+			self._store_row( row, user, lookup )
+			stored += 1
+		return stored, errors
+
+	def _store_rows(self, runner, rows):
+		"""
+		Store each row in its own transaction, reporting the rows that fail.
+		"""
+		stored = 0
+		errors = []
+		for row in rows:
+			try:
+				row_stored, row_errors = runner( lambda: self.store_batch( (row,) ),
+												 site_names=self.site_names )
+			except STORE_ERRORS as e:
+				row_stored = 0
+				row_errors = [_row_error( row, '%s' % e or e.__class__.__name__ )]
+			except Exception as e:
+				logger.exception( 'Registration import row failed (%s) (line=%s)',
+								  self.registration_id, row.line )
+				row_stored = 0
+				row_errors = [_row_error( row, 'Row failed (%s)' % e )]
+			stored += row_stored
+			errors.extend( row_errors )
+		return stored, errors
+
+	def __call__(self, job):
+		job.total = len( self.rows )
+		runner = component.getUtility( IDataserverTransactionRunner )
+		stored = 0
+		errors = []
+		for batch in batched( self.rows, self.batch_size ):
+			try:
+				batch_stored, batch_errors = runner( lambda: self.store_batch( batch ),
+													 site_names=self.site_names )
+			except Exception:
+				logger.info( 'Registration import batch failed, retrying by row (%s) (rows=%s)',
+							 self.registration_id, len( batch ) )
+				batch_stored, batch_errors = self._store_rows( runner, batch )
+			stored += batch_stored
+			errors.extend( batch_errors )
+			job.done += len( batch )
+		job.result = {'Stored': stored, 'Errors': errors}
+		logger.info( 'Registration import finished (%s) (stored=%s) (errors=%s)',
+					 self.registration_id, stored, len( errors ) )
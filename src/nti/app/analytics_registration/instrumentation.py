@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-phase timing and optional profiling of registration views.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import os
+import time
+import cProfile
+import tempfile
+import functools
+
+from collections import OrderedDict
+
+from contextlib import contextmanager
+
+from zope import component
+
+from nti.app.analytics_registration.metrics import get_registration_metrics
+
+from nti.common.string import is_true
+
+from nti.dataserver import authorization as nauth
+
+from nti.dataserver.interfaces import IDataserver
+
+#: The request environ key of the timer of the current view.
+TIMER_KEY = 'nti.app.analytics_registration.timer'
+
+#: The request param asking admins for a profile of the view.
+PROFILE_PARAM = 'profile'
+
+#: The response header naming the written profile.
+PROFILE_HEADER = 'X-Registration-Profile'
+
+PHASE_PARSE = 'parse'
+PHASE_USER_LOOKUP = 'user_lookup'
+PHASE_STORAGE = 'storage'
+PHASE_ENROLLMENT = 'enrollment'
+PHASE_CSV = 'csv'
+PHASE_RESPONSE = 'response'
+PHASE_TOTAL = 'total'
+
+class PhaseTimer(object):
+	"""
+	Accumulates the time spent in named phases of a view. Phases may nest,
+	as user lookups do within writing the CSV.
+	"""
+
+	def __init__(self, view_name):
+		self.view_name = view_name
+		self.phases = OrderedDict()
+		self.start = time.time()
+
+	@contextmanager
+	def phase(self, name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.phases[name] = self.phases.get( name, 0.0 ) + time.time() - start
+
+	def finish(self):
+		"""
+		Record the phase timings in the registration metrics and log them,
+		with the timings in milliseconds as structured log fields.
+		"""
+		self.phases[PHASE_TOTAL] = time.time() - self.start
+		metrics = get_registration_metrics()
+		if metrics is not None:
+			for name, seconds in self.phases.items():
+				metrics.observe( self.view_name, name, seconds )
+		timings = OrderedDict( (k, round( v * 1000, 1 )) for k, v in self.phases.items() )
+		logger.info( 'Registration view timings (%s) (%s)',
+					 self.view_name,
+					 ' '.join( '%s=%sms' % x for x in timings.items() ),
+					 extra={'registration_view': self.view_name,
+							'registration_timings': timings} )
+
+@contextmanager
+def time_phase(request, name):
+	"""
+	Time a phase of the view handling the request, if it is timed.
+	"""
+	environ = getattr( request, 'environ', None ) or {}
+	timer = environ.get( TIMER_KEY )
+	if timer is None:
+		yield
+	else:
+		with timer.phase( name ):
+			yield
+
+def _is_admin(request):
+	dataserver = component.queryUtility( IDataserver )
+	folder = getattr( dataserver, 'dataserver_folder', None )
+	return folder is not None and request.has_permission( nauth.ACT_NTI_ADMIN, folder )
+
+def _wants_profile(request):
+	return is_true( request.params.get( PROFILE_PARAM ) ) and _is_admin( request )
+
+def _dump_profile(request, view_name, profiler):
+	path = os.path.join( tempfile.gettempdir(),
+						 'registration-%s-%d.prof' % (view_name, time.time() * 1000) )
+	profiler.dump_stats( path )
+	request.response.headers[str( PROFILE_HEADER )] = str( path )
+	logger.info( 'Registration view profile written (%s) (%s)', view_name, path )
+
+def timed_view(cls):
+	"""
+	A class decorator timing the `__call__` of a view, by the view name of
+	the request. Admins may pass the `profile` param to have the call
+	profiled with cProfile; the dump path is logged and returned in the
+	`X-Registration-Profile` header.
+	"""
+	call = cls.__call__
+
+	@functools.wraps( call )
+	def __call__(self):
+		request = self.request
+		view_name = request.view_name or cls.__name__
+		timer = request.environ[TIMER_KEY] = PhaseTimer( view_name )
+		profiler = cProfile.Profile() if _wants_profile( request ) else None
+		if profiler is not None:
+			profiler.enable()
+		try:
+			return call( self )
+		finally:
+			if profiler is not None:
+				profiler.disable()
+				_dump_profile( request, view_name, profiler )
+			request.environ.pop( TIMER_KEY, None )
+			timer.finish()
+
+	cls.__call__ = __call__
+	return cls
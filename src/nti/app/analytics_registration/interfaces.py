@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+from zope import interface
+
+class INameParserCache(interface.Interface):
+	"""
+	A bounded, process-wide cache of parsed real names. Register a
+	different instance of this utility to change the eviction size.
+	"""
+
+	maxsize = interface.Attribute( "The maximum number of names held." )
+
+	hits = interface.Attribute( "The number of cached lookups." )
+
+	misses = interface.Attribute( "The number of lookups that parsed the name." )
+
+	def parse(realname):
+		"""
+		Return a tuple of (first name, last name) for the given realname.
+		"""
+
+	def clear():
+		"""
+		Empty the cache and reset the counters.
+		"""
+
+class IRegistrationRulesCache(interface.Interface):
+	"""
+	A process-wide cache of the registration rules document built for
+	each registration id.
+	"""
+
+	def get(registration_id, version=None):
+		"""
+		Return the cached :class:`RegistrationRulesEntry` built from the
+		given rules version, or None.
+		"""
+
+	def set(registration_id, document, version=None):
+		"""
+		Cache and return a new :class:`RegistrationRulesEntry` for the
+		given document, built from the given rules version.
+		"""
+
+	def invalidate(registration_id):
+		"""
+		Drop the cached document for the given registration id.
+		"""
+
+class IRegistrationRulesVersions(interface.Interface):
+	"""
+	The stored version of the rules and sessions of each registration id,
+	checked by every process before serving rules it has cached.
+	"""
+
+	def get(registration_id):
+		"""
+		Return the version, or None if the rules were never versioned.
+		"""
+
+	def touch(registration_id):
+		"""
+		Store a new version, once new rules or sessions are stored.
+		"""
+
+class ISurveyQuestionTypes(interface.Interface):
+	"""
+	The answer type of each survey question of each registration id,
+	fixed once the question is first answered.
+	"""
+
+	def get(registration_id, question_id):
+		"""
+		Return the answer type of the question, or None if not yet known.
+		"""
+
+	def note(registration_id, survey_data):
+		"""
+		Store the answer types of the questions of the survey data that
+		have none yet, returning how many were stored.
+		"""
+
+	def list_questions(registration_id):
+		"""
+		Return the keys of the questions answered with lists.
+		"""
+
+class IRegistrationRuleIndexCache(interface.Interface):
+	"""
+	A process-wide cache of the compiled rule index of each registration id.
+	"""
+
+	def get(registration_id, version=None):
+		"""
+		Return the cached :class:`RegistrationRuleIndex`, or None if none is
+		cached for the given rules version.
+		"""
+
+	def set(registration_id, index):
+		"""
+		Cache the index for the given registration id.
+		"""
+
+	def invalidate(registration_id):
+		"""
+		Drop the cached index for the given registration id.
+		"""
+
+class IRegistrationJobQueue(interface.Interface):
+	"""
+	Runs long-running registration work off of the request thread. Jobs
+	may only be known to the process that queued them.
+	"""
+
+	def submit(func, name=None, job_id=None):
+		"""
+		Queue `func`, called with the new job, and return the job. If
+		`job_id` names an unfinished job, that job is returned instead.
+		"""
+
+	def get(job_id):
+		"""
+		Return the job with the given id, or None if it is unknown here.
+		"""
+
+class IRegistrationCounters(interface.Interface):
+	"""
+	Registration counts per registration id, kept up to date as
+	registrations are stored, updated and removed.
+	"""
+
+	def tracks(registration_id):
+		"""
+		Whether counts are maintained for the registration id.
+		"""
+
+	def registration_ids():
+		"""
+		The registration ids counts are maintained for.
+		"""
+
+	def add(registration_id, registration):
+		"""
+		Count a new registration.
+		"""
+
+	def remove(registration_id, registration):
+		"""
+		Stop counting a removed registration.
+		"""
+
+	def update(registration_id, dimension, old_value, new_value):
+		"""
+		Move a registration between values of a counted dimension.
+		"""
+
+	def prepare(registration_id, values):
+		"""
+		Create the counts for the given (dimension, value) pairs ahead of
+		registrations, so that concurrent registrations only change them.
+		"""
+
+	def reset(registration_id, registrations=()):
+		"""
+		Rebuild the counts of a registration id from its registrations.
+		"""
+
+	def clear():
+		"""
+		Drop all counts; counting restarts with the next upload or rebuild.
+		"""
+
+	def get_counts(registration_id):
+		"""
+		Return a dict of dimension to value to count, or None if the
+		counts of this registration id have not been built.
+		"""
+
+class ISessionSeats(interface.Interface):
+	"""
+	Seats taken, and optional capacities, per (course_ntiid, session_range)
+	of each registration id.
+	"""
+
+	def tracks(registration_id):
+		"""
+		Whether seats are counted for the registration id.
+		"""
+
+	def registration_ids():
+		"""
+		The registration ids seats are counted for.
+		"""
+
+	def take(registration_id, course_ntiid, session_range, delta=1):
+		"""
+		Take (or, with a negative delta, release) seats in a session.
+		"""
+
+	def reset(registration_id, capacities, taken=()):
+		"""
+		Start counting seats for the registration id, given a dict of
+		(course_ntiid, session_range) to capacity (or None if unlimited)
+		and the (course_ntiid, session_range) of each existing registration.
+		"""
+
+	def is_full(registration_id, course_ntiid, session_range):
+		"""
+		Whether every seat of a session with a capacity is taken.
+		"""
+
+	def get_capacities(registration_id):
+		"""
+		Return a dict of (course_ntiid, session_range) to capacity.
+		"""
+
+	def get_remaining(registration_id):
+		"""
+		Return a dict of course_ntiid to session_range to remaining seats,
+		for the sessions with a capacity.
+		"""
+
+class IRegistrationMetrics(interface.Interface):
+	"""
+	Process-wide counts of registration events, such as submission
+	attempts and transaction retries.
+	"""
+
+	def incr(name, count=1):
+		"""
+		Add to the named count.
+		"""
+
+	def get(name):
+		"""
+		Return the named count.
+		"""
+
+	def observe(view_name, phase, seconds):
+		"""
+		Record the time spent in a phase of a view.
+		"""
+
+	def snapshot():
+		"""
+		Return a dict of every count.
+		"""
+
+	def timings():
+		"""
+		Return a dict of (view name, phase) to (count, total seconds).
+		"""
+
+	def clear():
+		"""
+		Reset every count.
+		"""
+
+class ICourseLookupCache(interface.Interface):
+	"""
+	An optional, process-wide cache of course NTIID lookups. Register a
+	utility providing this to share lookups across requests.
+	"""
+
+	def get(course_ntiid, connection):
+		"""
+		Return the course loaded from the given connection, or None.
+		"""
+
+	def set(course_ntiid, course):
+		"""
+		Remember where the course is stored.
+		"""
+
+	def invalidate(course_ntiid=None):
+		"""
+		Forget the course, or every course.
+		"""
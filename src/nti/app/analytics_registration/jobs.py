@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A local, in-process job queue for long-running registration work.
+
+Jobs, their progress and their results live only in the process that
+queued them. With several app server processes, status and download
+requests must reach the process that started the job (e.g. with sticky
+sessions); elsewhere the job is not found. Each job names its `owner`
+process so that clients and routing can tell which one that is. Jobs
+are also lost when their process restarts.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import os
+import time
+import socket
+
+from threading import Lock
+from threading import Thread
+
+from uuid import uuid4
+
+from six.moves.queue import Queue
+
+from zope import interface
+
+from nti.app.analytics_registration.interfaces import IRegistrationJobQueue
+
+#: The number of worker threads started by default.
+DEFAULT_JOB_WORKERS = 2
+
+#: The number of seconds finished jobs (and their results) are kept.
+JOB_EXPIRATION = 60 * 60
+
+#: The host and pid of this process, the owner of the jobs it queues.
+JOB_OWNER = '%s:%s' % (socket.gethostname(), os.getpid())
+
+JOB_PENDING = 'Pending'
+JOB_RUNNING = 'Running'
+JOB_SUCCESS = 'Success'
+JOB_FAILED = 'Failed'
+
+class RegistrationJob(object):
+	"""
+	The status of a queued job. Jobs report their progress by updating
+	`total` and `done`, and may leave a `result`. The `owner` is the
+	process running the job.
+	"""
+
+	def __init__(self, job_id, name=None):
+		self.id = job_id
+		self.name = name
+		self.owner = JOB_OWNER
+		self.state = JOB_PENDING
+		self.total = None
+		self.done = 0
+		self.error = None
+		self.result = None
+		self.created = time.time()
+		self.finished = None
+		self._lock = Lock()
+
+	@property
+	def is_finished(self):
+		return self.state in (JOB_SUCCESS, JOB_FAILED)
+
+	def iter_result(self, chunk_size=64 * 1024):
+		"""
+		Iterate over the contents of a file result. Each chunk is read at
+		its own offset, so concurrent readers do not interfere.
+		"""
+		offset = 0
+		while True:
+			with self._lock:
+				self.result.seek( offset )
+				data = self.result.read( chunk_size )
+			if not data:
+				break
+			offset += len( data )
+			yield data
+
+	def close(self):
+		close = getattr( self.result, 'close', None )
+		if close is not None:
+			close()
+
+@interface.implementer(IRegistrationJobQueue)
+class LocalJobQueue(object):
+	"""
+	Runs jobs on a fixed pool of daemon worker threads, started on the
+	first submission. No outside broker is needed; jobs only live in this
+	process, so other processes (and this one, after a restart) cannot
+	find them.
+	"""
+
+	def __init__(self, workers=DEFAULT_JOB_WORKERS):
+		self.workers = workers
+		self._queue = Queue()
+		self._jobs = {}
+		self._threads = []
+		self._lock = Lock()
+
+	def _start(self):
+		with self._lock:
+			self._threads = [x for x in self._threads if x.is_alive()]
+			while len( self._threads ) < self.workers:
+				thread = Thread( target=self._work,
+								 name='RegistrationJobWorker-%s' % len( self._threads ) )
+				thread.daemon = True
+				thread.start()
+				self._threads.append( thread )
+
+	def _work(self):
+		while True:
+			job, func = self._queue.get()
+			job.state = JOB_RUNNING
+			try:
+				func( job )
+				job.state = JOB_SUCCESS
+			except Exception as e:
+				logger.exception( 'Registration job failed (%s) (%s)', job.name, job.id )
+				job.error = '%s' % e
+				job.state = JOB_FAILED
+			finally:
+				job.finished = time.time()
+				self._queue.task_done()
+
+	def _prune(self):
+		expired = time.time() - JOB_EXPIRATION
+		with self._lock:
+			for job_id, job in list( self._jobs.items() ):
+				if job.is_finished and job.finished < expired:
+					job.close()
+					del self._jobs[job_id]
+
+	def submit(self, func, name=None, job_id=None):
+		self._prune()
+		job = RegistrationJob( job_id or uuid4().hex, name )
+		with self._lock:
+			existing = self._jobs.get( job.id )
+			if existing is not None and not existing.is_finished:
+				# Keep submissions idempotent for the same job id.
+				return existing
+			self._jobs[job.id] = job
+		self._start()
+		self._queue.put( (job, func) )
+		return job
+
+	def get(self, job_id):
+		return self._jobs.get( job_id )
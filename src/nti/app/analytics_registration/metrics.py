@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Process-wide registration metrics.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+from threading import Lock
+
+import transaction
+
+try:
+	from perfmetrics import statsd_client
+except ImportError: # pragma: no cover
+	statsd_client = lambda: None
+
+from zope import component
+from zope import interface
+
+from nti.app.analytics_registration.interfaces import IRegistrationMetrics
+
+SUBMIT_ATTEMPTS = 'submit.attempts'
+SUBMIT_RETRIES = 'submit.retries'
+SUBMIT_COMMITTED = 'submit.committed'
+SUBMIT_FAILED = 'submit.failed'
+
+#: The prefix of our statsd and Prometheus metric names.
+METRIC_PREFIX = 'nti.registration'
+
+#: The request environ key counting the attempts of a submission.
+SUBMIT_ATTEMPT_KEY = 'nti.app.analytics_registration.submit_attempt'
+
+@interface.implementer(IRegistrationMetrics)
+class RegistrationMetrics(object):
+	"""
+	Thread-safe named counts and view phase timings, kept in memory for
+	this process. Everything is also sent to statsd, if perfmetrics has
+	a client configured.
+	"""
+
+	def __init__(self):
+		self._lock = Lock()
+		self._counts = {}
+		self._timings = {}
+
+	def incr(self, name, count=1):
+		with self._lock:
+			self._counts[name] = self._counts.get( name, 0 ) + count
+		client = statsd_client()
+		if client is not None:
+			client.incr( '%s.%s' % (METRIC_PREFIX, name), count )
+
+	def observe(self, view_name, phase, seconds):
+		key = (view_name, phase)
+		with self._lock:
+			count, total = self._timings.get( key, (0, 0.0) )
+			self._timings[key] = (count + 1, total + seconds)
+		client = statsd_client()
+		if client is not None:
+			client.timing( '%s.%s.%s' % (METRIC_PREFIX, view_name, phase),
+						   int( seconds * 1000 ) )
+
+	def get(self, name):
+		return self._counts.get( name, 0 )
+
+	def snapshot(self):
+		with self._lock:
+			return dict( self._counts )
+
+	def timings(self):
+		with self._lock:
+			return dict( self._timings )
+
+	def clear(self):
+		with self._lock:
+			self._counts.clear()
+			self._timings.clear()
+
+def get_registration_metrics():
+	return component.queryUtility( IRegistrationMetrics )
+
+def record_submit_attempt(request):
+	"""
+	Count a registration submission attempt. The transaction loop re-runs
+	the view with the same environ after a conflict, so a marker in the
+	environ tells retries apart. Whether the attempt commits is counted
+	once the transaction finishes.
+	"""
+	metrics = get_registration_metrics()
+	if metrics is None:
+		return
+	attempt = request.environ.get( SUBMIT_ATTEMPT_KEY, 0 ) + 1
+	request.environ[SUBMIT_ATTEMPT_KEY] = attempt
+	metrics.incr( SUBMIT_ATTEMPTS )
+	if attempt > 1:
+		metrics.incr( SUBMIT_RETRIES )
+		logger.info( 'Retrying registration submission (attempt=%s)', attempt )
+
+	def _after_commit(success):
+		metrics.incr( SUBMIT_COMMITTED if success else SUBMIT_FAILED )
+	transaction.get().addAfterCommitHook( _after_commit )
+
+def _prometheus_name(name):
+	return ('%s.%s' % (METRIC_PREFIX, name)).replace( '.', '_' )
+
+def to_prometheus(metrics):
+	"""
+	Return the metrics in the Prometheus text exposition format: a
+	counter per count, and a summary of the phase timings of each view.
+	"""
+	lines = []
+	for name, value in sorted( metrics.snapshot().items() ):
+		name = _prometheus_name( name ) + '_total'
+		lines.append( '# TYPE %s counter' % name )
+		lines.append( '%s %s' % (name, value) )
+	name = _prometheus_name( 'view_phase_seconds' )
+	lines.append( '# TYPE %s summary' % name )
+	for (view_name, phase), (count, total) in sorted( metrics.timings().items() ):
+		labels = '{view="%s",phase="%s"}' % (view_name, phase)
+		lines.append( '%s_count%s %s' % (name, labels, count) )
+		lines.append( '%s_sum%s %.6f' % (name, labels, total) )
+	lines.append( '' )
+	return '\n'.join( lines )
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers to order and page registrations by (timestamp, id).
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import sys
+import math
+import time
+import heapq
+import base64
+import calendar
+
+#: The seconds a registration may take to commit after its timestamp is
+#: taken (before storing). Watermarks are never later than this long ago,
+#: so registrations committed after an export, with an earlier timestamp
+#: than its last row, are exported next time rather than skipped.
+WATERMARK_LAG = 60
+
+def _timestamp_key(timestamp):
+	"""
+	Microseconds since the epoch of the given naive UTC datetime.
+	"""
+	if timestamp is None:
+		return 0
+	seconds = calendar.timegm( timestamp.utctimetuple() )
+	return seconds * 1000000 + timestamp.microsecond
+
+def registration_sort_key(registration):
+	"""
+	The (timestamp, id) key registrations are ordered and paged by.
+	The id breaks ties between registrations stored in the same instant.
+	"""
+	return (_timestamp_key( registration.timestamp ),
+			registration.user_registration_id or 0)
+
+def encode_cursor(key):
+	"""
+	Return an opaque cursor string for a registration sort key.
+	"""
+	value = '%d:%d' % key
+	return base64.urlsafe_b64encode( value.encode( 'ascii' ) ).decode( 'ascii' )
+
+def decode_cursor(cursor):
+	"""
+	Return the registration sort key for the given cursor, raising a
+	:class:`ValueError` if the cursor is malformed.
+	"""
+	try:
+		value = base64.urlsafe_b64decode( str( cursor ) ).decode( 'ascii' )
+		timestamp, registration_id = value.split( ':' )
+		return int( timestamp ), int( registration_id )
+	except (TypeError, UnicodeError):
+		raise ValueError( 'Invalid cursor (%s)' % cursor )
+
+def parse_watermark(value):
+	"""
+	Return the sort key registrations must follow for the given watermark:
+	either a cursor, or a timestamp in seconds since the epoch. Raises a
+	:class:`ValueError` for anything else.
+	"""
+	try:
+		seconds = float( value )
+	except ValueError:
+		return decode_cursor( value )
+	if math.isinf( seconds ) or math.isnan( seconds ):
+		raise ValueError( 'Invalid watermark (%s)' % value )
+	# After every registration stored in that instant.
+	return int( round( seconds * 1000000 ) ), sys.maxsize
+
+def cap_watermark(key, now=None):
+	"""
+	Return the given sort key, or the key of `WATERMARK_LAG` seconds ago
+	if that is earlier. Registrations after a capped watermark may be
+	exported again; none that commit late are skipped.
+	"""
+	now = time.time() if now is None else now
+	cutoff = (int( (now - WATERMARK_LAG) * 1000000 ), 0)
+	return min( key, cutoff )
+
+def ordered_registrations(registrations):
+	"""
+	Return the given registrations ordered by :func:`registration_sort_key`,
+	sorting a list in place. Ties on timestamp are ordered by id, so that
+	the last registration exported is a correct watermark.
+	"""
+	if not isinstance( registrations, list ):
+		registrations = list( registrations )
+	registrations.sort( key=registration_sort_key )
+	return registrations
+
+def registrations_after(registrations, after=None, limit=None):
+	"""
+	Return the `limit` registrations ordered after the `after` key, in
+	order. Only the requested page is ever sorted, rather than the full
+	set of registrations.
+	"""
+	if after is not None:
+		registrations = (x for x in registrations
+						 if registration_sort_key( x ) > after)
+	if limit is None:
+		return sorted( registrations, key=registration_sort_key )
+	return heapq.nsmallest( limit, registrations, key=registration_sort_key )
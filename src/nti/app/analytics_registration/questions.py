@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The fixed answer type of each survey question, so typed exports give a
+question the same column type in every file.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.annotation.factory import factory as an_factory
+
+from zope.container.contained import Contained
+
+from nti.app.analytics_registration.interfaces import ISurveyQuestionTypes
+
+from nti.app.analytics_registration.survey import get_question_key
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IDataserverFolder
+
+#: A question answered with a list of values.
+LIST_ANSWER = 'list'
+
+#: A question answered with a single value.
+TEXT_ANSWER = 'text'
+
+def get_answer_type(response):
+	return LIST_ANSWER if isinstance( response, (list, tuple) ) else TEXT_ANSWER
+
+@component.adapter(IDataserverFolder)
+@interface.implementer(ISurveyQuestionTypes)
+class SurveyQuestionTypes(Persistent, Contained):
+	"""
+	The answer type of each survey question of each registration id, fixed
+	by the first answer stored for the question.
+	"""
+
+	def __init__(self):
+		# registration_id -> question key -> answer type
+		self._types = OOBTree()
+
+	def get(self, registration_id, question_id):
+		types = self._types.get( registration_id )
+		if types is None:
+			return None
+		return types.get( get_question_key( question_id ) )
+
+	def note(self, registration_id, survey_data):
+		result = 0
+		types = self._types.get( registration_id )
+		for question_id, response in (survey_data or {}).items():
+			key = get_question_key( question_id )
+			# Only new questions are written, to keep submissions from
+			# conflicting on this object.
+			if types is not None and key in types:
+				continue
+			if types is None:
+				types = self._types[registration_id] = OOBTree()
+			types[key] = get_answer_type( response )
+			result += 1
+		return result
+
+	def list_questions(self, registration_id):
+		types = self._types.get( registration_id ) or {}
+		return set( k for k, v in types.items() if v == LIST_ANSWER )
+
+SurveyQuestionTypesFactory = an_factory( SurveyQuestionTypes,
+										 'nti.app.analytics_registration.questions' )
+
+def get_survey_question_types():
+	dataserver = component.getUtility( IDataserver )
+	return ISurveyQuestionTypes( dataserver.dataserver_folder )
+
+def note_survey_answers(registration_id, survey_data):
+	"""
+	Fix the answer type of the survey questions answered for the first time.
+	"""
+	noted = get_survey_question_types().note( registration_id, survey_data )
+	if noted:
+		logger.info( 'Survey question types stored (%s) (count=%s)',
+					 registration_id, noted )
+
+def get_list_columns(registration_id, layout):
+	"""
+	The survey columns of the layout for questions answered with lists.
+	Questions without a stored type (answered before types were kept)
+	are text until they are next answered.
+	"""
+	list_keys = get_survey_question_types().list_questions( registration_id )
+	return [layout.columns[i] for key, i in layout.index.items() if key in list_keys]
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Removal of registrations, unenrolling their users, optionally in batches
+of users, each in its own transaction.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+from zope import component
+
+from nti.analytics_registration.registration import get_user_registrations
+from nti.analytics_registration.registration import delete_user_registrations
+
+from nti.app.analytics_registration.counters import get_session_seats
+from nti.app.analytics_registration.counters import rebuild_session_seats
+from nti.app.analytics_registration.counters import get_registration_counters
+from nti.app.analytics_registration.counters import start_registration_counts
+
+from nti.app.analytics_registration.courses import get_course_resolver
+
+from nti.app.analytics_registration.view_mixins import batched
+
+from nti.contenttypes.courses.interfaces import ICourseEnrollments
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.dataserver.users import User
+
+#: The largest number of users whose registrations are removed per
+#: transaction.
+MAX_REMOVAL_BATCH_SIZE = 1000
+
+def drop_users(lookup, users):
+	"""
+	Drop the enrolled users from the course, all at once if they are
+	every enrollment of the course. Returns the number dropped.
+	"""
+	enrollments = ICourseEnrollments( lookup.course )
+	enrolled = [x for x in users
+				if enrollments.get_enrollment_for_principal( x ) is not None]
+	if enrolled and len( enrolled ) == enrollments.count_enrollments():
+		lookup.manager.drop_all()
+	else:
+		for user in enrolled:
+			lookup.manager.drop( user )
+	return len( enrolled )
+
+def unenroll_registrations(deleted, resolver=None):
+	"""
+	Drop the users of the deleted (registration, course_ntiid) pairs from
+	their courses, grouped by course, so that each course is resolved once
+	and each user dropped once. Returns the number of drops.
+	"""
+	users_by_course = {}
+	for registration, course_ntiid in deleted:
+		user = registration.user
+		if user is not None:
+			users = users_by_course.setdefault( course_ntiid, {} )
+			users[user.username.lower()] = user
+
+	result = 0
+	resolver = resolver if resolver is not None else get_course_resolver()
+	for course_ntiid, users in users_by_course.items():
+		lookup = resolver.resolve( course_ntiid )
+		if lookup is None:
+			logger.warn( 'No course found for (%s) (users=%s)',
+						 course_ntiid, len( users ) )
+			continue
+		dropped = drop_users( lookup, users.values() )
+		result += dropped
+		logger.info( 'Users unenrolled (%s) (count=%s)', course_ntiid, dropped )
+	return result
+
+def recount_registrations():
+	"""
+	Recount every maintained registration id, and its seats.
+	"""
+	counters = get_registration_counters()
+	for registration_id in counters.registration_ids():
+		start_registration_counts( registration_id, rebuild=True )
+	for registration_id in get_session_seats().registration_ids():
+		rebuild_session_seats( registration_id )
+
+def uncount_registrations(registration_id, deleted):
+	"""
+	Update the counts and seats of the registration id for the deleted
+	(registration, course_ntiid) pairs. Without a registration id, the
+	deleted registrations may span registration ids, so everything is
+	recounted.
+	"""
+	if not registration_id:
+		recount_registrations()
+		return
+	counters = get_registration_counters()
+	seats = get_session_seats()
+	# We get a registration per course it enrolled in.
+	seen = set()
+	for registration, course_ntiid in deleted:
+		seats.take( registration_id, course_ntiid,
+					registration.session_range, -1 )
+		if id( registration ) not in seen:
+			seen.add( id( registration ) )
+			counters.remove( registration_id, registration )
+
+def count_deleted(deleted):
+	return len( set( id( x ) for x, unused_course in deleted ) )
+
+class RegistrationRemover(object):
+	"""
+	Removes the registrations of every user of a registration id (or of
+	every registration id), a batch of users per transaction. The users
+	are listed once, up front; each batch only touches its own users. The
+	job result has the totals and the counts of each batch.
+	"""
+
+	def __init__(self, registration_id, batch_size, unenroll=True, site_names=()):
+		self.registration_id = registration_id
+		self.batch_size = batch_size
+		self.unenroll = unenroll
+		self.site_names = site_names
+
+	def get_usernames(self):
+		result = set()
+		for registration in get_user_registrations( None, self.registration_id ) or ():
+			if registration.user is not None:
+				result.add( registration.user.username )
+		return sorted( result )
+
+	def remove_batch(self, usernames):
+		"""
+		Remove the registrations of the users in the current transaction,
+		returning the number of registrations deleted and of users
+		unenrolled.
+		"""
+		deleted = []
+		for username in usernames:
+			user = User.get_user( username )
+			if user is not None:
+				deleted.extend( delete_user_registrations( user, self.registration_id ))
+		if self.registration_id:
+			uncount_registrations( self.registration_id, deleted )
+		unenrolled = unenroll_registrations( deleted ) if self.unenroll else 0
+		return count_deleted( deleted ), unenrolled
+
+	def __call__(self, job):
+		runner = component.getUtility( IDataserverTransactionRunner )
+		usernames = runner( self.get_usernames,
+							site_names=self.site_names,
+							side_effect_free=True )
+		job.total = len( usernames )
+		deleted = unenrolled = 0
+		batches = []
+		for batch in batched( usernames, self.batch_size ):
+			batch_deleted, batch_unenrolled = runner( lambda: self.remove_batch( batch ),
+													  site_names=self.site_names )
+			deleted += batch_deleted
+			unenrolled += batch_unenrolled
+			batches.append( {'Users': len( batch ),
+							 'Deleted': batch_deleted,
+							 'Unenrolled': batch_unenrolled} )
+			job.done += len( batch )
+			logger.info( 'Deleted registration batch (registration=%s) (users=%s) (done=%s/%s)',
+						 self.registration_id, len( batch ), job.done, job.total )
+		if not self.registration_id:
+			runner( recount_registrations, site_names=self.site_names )
+		job.result = {'Users': len( usernames ),
+					  'Deleted': deleted,
+					  'Unenrolled': unenrolled,
+					  'Batches': batches}
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compiled registration rules, for validating course choices in memory, and
+the stored rules versions process-wide rules caches are checked against.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+import time
+
+from threading import Lock
+
+import six
+
+import transaction
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.annotation.factory import factory as an_factory
+
+from zope.container.contained import Contained
+
+from nti.analytics_registration.registration import get_registration_rules
+from nti.analytics_registration.registration import get_registration_sessions
+
+from nti.app.analytics_registration.interfaces import IRegistrationRulesCache
+from nti.app.analytics_registration.interfaces import IRegistrationRulesVersions
+from nti.app.analytics_registration.interfaces import IRegistrationRuleIndexCache
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IDataserverFolder
+
+def _as_text(value):
+	return six.text_type( value ) if value is not None else None
+
+class RegistrationRuleIndex(object):
+	"""
+	The valid (school, grade, course_ntiid) choices, with the curriculum
+	each maps to, and the (course_ntiid, session_range) sessions of a
+	registration id, built from the given rules version.
+	"""
+
+	def __init__(self, rules=(), sessions=(), version=None):
+		self.curricula = {}
+		for rule in rules:
+			key = (rule.school, _as_text( rule.grade_teaching ), rule.course_ntiid)
+			self.curricula.setdefault( key, rule.curriculum )
+		self.courses = frozenset( self.curricula )
+		self.sessions = frozenset( (x.course_ntiid, x.session_range) for x in sessions )
+		self.version = version
+
+	def is_valid_course(self, school, grade, course_ntiid):
+		return (school, _as_text( grade ), course_ntiid) in self.courses
+
+	def get_curriculum(self, school, grade, course_ntiid):
+		return self.curricula.get( (school, _as_text( grade ), course_ntiid) )
+
+	def is_valid_session(self, course_ntiid, session_range):
+		return (course_ntiid, session_range) in self.sessions
+
+@interface.implementer(IRegistrationRuleIndexCache)
+class RegistrationRuleIndexCache(object):
+	"""
+	Caches the rule index of each registration id. An index is only
+	returned for the rules version it was built from, so rules stored by
+	any process replace it.
+	"""
+
+	def __init__(self):
+		self._lock = Lock()
+		self._data = {}
+
+	def get(self, registration_id, version=None):
+		index = self._data.get( registration_id )
+		if index is not None and index.version != version:
+			index = None
+		return index
+
+	def set(self, registration_id, index):
+		with self._lock:
+			self._data[registration_id] = index
+
+	def invalidate(self, registration_id):
+		with self._lock:
+			self._data.pop( registration_id, None )
+
+def build_rule_index(registration_id, version=None):
+	rules = get_registration_rules( registration_id ) or ()
+	sessions = get_registration_sessions( registration_id ) or ()
+	return RegistrationRuleIndex( rules, sessions, version )
+
+def get_rule_index(registration_id):
+	"""
+	Return the cached rule index of the registration id if it was built
+	from the stored rules version, or build it from the stored rules and
+	sessions.
+	"""
+	version = get_rules_version( registration_id )
+	cache = component.queryUtility( IRegistrationRuleIndexCache )
+	result = cache.get( registration_id, version ) if cache is not None else None
+	if result is None:
+		result = build_rule_index( registration_id, version )
+		if cache is not None:
+			cache.set( registration_id, result )
+	return result
+
+@component.adapter(IDataserverFolder)
+@interface.implementer(IRegistrationRulesVersions)
+class RegistrationRulesVersions(Persistent, Contained):
+	"""
+	When the rules or sessions of each registration id were last stored,
+	in seconds since the epoch. Rules cached by any process are only
+	served for the current version.
+	"""
+
+	def __init__(self):
+		# registration_id -> version
+		self._versions = OOBTree()
+
+	def get(self, registration_id):
+		return self._versions.get( registration_id )
+
+	def touch(self, registration_id):
+		self._versions[registration_id] = time.time()
+
+RegistrationRulesVersionsFactory = an_factory( RegistrationRulesVersions,
+											   'nti.app.analytics_registration.rules' )
+
+def get_rules_versions():
+	dataserver = component.getUtility( IDataserver )
+	return IRegistrationRulesVersions( dataserver.dataserver_folder )
+
+def get_rules_version(registration_id):
+	return get_rules_versions().get( registration_id )
+
+def invalidate_registration_rules(registration_id):
+	"""
+	Store a new rules version for the registration id, so every process
+	rebuilds its cached rules, and drop the cached rules (and rule index)
+	of this process, both now and once the current transaction commits,
+	so that rules built from the old rules by a concurrent request are not
+	left in the cache.
+	"""
+	get_rules_versions().touch( registration_id )
+	caches = [component.queryUtility( IRegistrationRulesCache ),
+			  component.queryUtility( IRegistrationRuleIndexCache )]
+	caches = [x for x in caches if x is not None]
+	if not caches:
+		return
+
+	def _invalidate(success=True):
+		if success:
+			for cache in caches:
+				cache.invalidate( registration_id )
+	_invalidate()
+	transaction.get().addAfterCommitHook( _invalidate )
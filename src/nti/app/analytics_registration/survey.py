@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Survey column layouts for registration exports.
+
+.. $Id$
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+logger = __import__('logging').getLogger(__name__)
+
+def get_question_key(question_id):
+	# Remove whitespace
+	return '_'.join( question_id.split() )
+
+def get_survey_display(question_id):
+	return 'Survey: %s' % question_id
+
+class SurveyColumnLayout(object):
+	"""
+	The survey columns of a registration export, with a precompiled index
+	of question key to column, so each row fills a preallocated list.
+	Layouts are built per export, so every stored question has a column.
+	"""
+
+	def __init__(self, question_ids):
+		displays = {}
+		for question_id in question_ids:
+			displays[get_question_key( question_id )] = get_survey_display( question_id )
+		#: The sorted display names of the survey columns.
+		self.columns = sorted( displays.values() )
+		position = dict( (display, i) for i, display in enumerate( self.columns ) )
+		#: Question key to column index.
+		self.index = dict( (key, position[display]) for key, display in displays.items() )
+		# Raw question id to column index, per survey version.
+		self._version_index = {}
+		#: Set once a row has a question this layout does not know about.
+		self.stale = False
+
+	def build_row(self, survey_version, details, join_lists=True):
+		"""
+		Return the survey version followed by the survey column values
+		for the given (question_id, response) pairs. Questions without a
+		response are given an empty string.
+		"""
+		values = [''] * (len( self.columns ) + 1)
+		values[0] = survey_version
+		version_index = self._version_index.setdefault( survey_version, {} )
+		for question_id, response in details:
+			column = version_index.get( question_id )
+			if column is None:
+				column = self.index.get( get_question_key( question_id ) )
+				if column is None:
+					if not self.stale:
+						logger.warn( 'Survey question missing from layout (%s)',
+									 question_id )
+						self.stale = True
+					continue
+				version_index[question_id] = column
+			if join_lists and isinstance( response, list ):
+				# Make sure our list response is readable.
+				response = ', '.join( (str(x) for x in response) )
+			values[column + 1] = response
+		return values
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import same_instance
+
+import unittest
+
+from nti.app.analytics_registration.caches import NameParserCache
+from nti.app.analytics_registration.caches import RegistrationRulesCache
+
+class TestNameParserCache(unittest.TestCase):
+
+	def test_lru(self):
+		cache = NameParserCache( maxsize=2 )
+		assert_that( cache.parse( 'Phil Krundle' ), is_( ('Phil', 'Krundle') ))
+		assert_that( cache.misses, is_( 1 ))
+		assert_that( cache.parse( 'Phil Krundle' ), is_( ('Phil', 'Krundle') ))
+		assert_that( cache.hits, is_( 1 ))
+
+		cache.parse( 'Jane Doe' )
+		# Touch the oldest entry, then evict the least recently used.
+		cache.parse( 'Phil Krundle' )
+		cache.parse( 'John Smith' )
+		assert_that( cache, has_length( 2 ))
+		assert_that( dict( cache._data ), is_( {'Phil Krundle': ('Phil', 'Krundle'),
+												'John Smith': ('John', 'Smith')} ))
+		assert_that( cache.hits, is_( 2 ))
+		assert_that( cache.misses, is_( 3 ))
+
+		cache.clear()
+		assert_that( cache, has_length( 0 ))
+		assert_that( cache.hits, is_( 0 ))
+
+class TestRegistrationRulesCache(unittest.TestCase):
+
+	def test_versions(self):
+		cache = RegistrationRulesCache()
+		entry = cache.set( 'reg', {'rules': 1}, version=10.0 )
+		assert_that( entry.last_modified, is_( 10.0 ))
+		assert_that( cache.get( 'reg', 10.0 ), same_instance( entry ))
+		# Rules stored since, by any process.
+		assert_that( cache.get( 'reg', 11.0 ), none() )
+
+		# Unversioned rules keep their first modification time.
+		entry = cache.set( 'other', {'rules': 2} )
+		assert_that( cache.get( 'other' ), same_instance( entry ))
+		assert_that( cache.set( 'other', {'rules': 2} ).last_modified,
+					 is_( entry.last_modified ))
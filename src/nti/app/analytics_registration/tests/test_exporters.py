@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import contains
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import raises
+
+import unittest
+
+from zope import component
+from zope import interface
+
+from nti.app.analytics_registration.exporters import iter_in_transaction
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+@interface.implementer(IDataserverTransactionRunner)
+class _Runner(object):
+
+	def __init__(self):
+		self.calls = []
+
+	def __call__(self, func, site_names=(), side_effect_free=False):
+		self.calls.append( (site_names, side_effect_free) )
+		return func()
+
+class TestStreamedExport(unittest.TestCase):
+
+	def setUp(self):
+		self.runner = _Runner()
+		component.getGlobalSiteManager().registerUtility( self.runner,
+														  IDataserverTransactionRunner )
+
+	def tearDown(self):
+		component.getGlobalSiteManager().unregisterUtility( self.runner,
+															IDataserverTransactionRunner )
+
+	def test_chunks(self):
+		built = []
+		def _iter_chunks():
+			for chunk in (b'header', b'a', b'b'):
+				built.append( chunk )
+				yield chunk
+
+		chunks = iter_in_transaction( _iter_chunks, ('site',), queue_size=1 )
+		# Nothing is built until the response is written.
+		assert_that( built, is_( [] ))
+		assert_that( list( chunks ), contains( b'header', b'a', b'b' ))
+		assert_that( self.runner.calls, contains( (('site',), True) ))
+
+	def test_errors(self):
+		def _iter_chunks():
+			yield b'header'
+			raise ValueError( 'storage' )
+
+		chunks = iter_in_transaction( _iter_chunks )
+		assert_that( next( chunks ), is_( b'header' ))
+		assert_that( calling( next ).with_args( chunks ), raises( ValueError ))
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import unittest
+
+from nti.app.analytics_registration.formats import has_arrow
+from nti.app.analytics_registration.formats import arrow_schema
+
+class TestFormats(unittest.TestCase):
+
+	@unittest.skipUnless( has_arrow(), 'pyarrow is not installed' )
+	def test_arrow_schema(self):
+		import pyarrow
+		schema = arrow_schema( ('username', 'registration_date'),
+							   ('survey_list', 'survey_text'),
+							   ('survey_list',) )
+		assert_that( schema.field( 'username' ).type, is_( pyarrow.string() ))
+		assert_that( pyarrow.types.is_timestamp( schema.field( 'registration_date' ).type ),
+					 is_( True ))
+		assert_that( schema.field( 'survey_list' ).type,
+					 is_( pyarrow.list_( pyarrow.string() ) ))
+		assert_that( schema.field( 'survey_text' ).type, is_( pyarrow.string() ))
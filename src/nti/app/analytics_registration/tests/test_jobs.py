@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import assert_that
+from hamcrest import same_instance
+
+import unittest
+
+from io import BytesIO
+
+from threading import Event
+
+from nti.app.analytics_registration.jobs import JOB_OWNER
+from nti.app.analytics_registration.jobs import JOB_FAILED
+from nti.app.analytics_registration.jobs import JOB_SUCCESS
+from nti.app.analytics_registration.jobs import LocalJobQueue
+
+class TestLocalJobQueue(unittest.TestCase):
+
+	def _wait(self, queue):
+		queue._queue.join()
+
+	def test_jobs(self):
+		queue = LocalJobQueue( workers=1 )
+
+		def _work(job):
+			job.total = 2
+			job.done = 2
+			job.result = BytesIO( b'a,b\r\n1,2\r\n' )
+
+		job = queue.submit( _work, name='Test' )
+		self._wait( queue )
+		assert_that( queue.get( job.id ), same_instance( job ))
+		assert_that( job.owner, is_( JOB_OWNER ))
+		assert_that( job.state, is_( JOB_SUCCESS ))
+		assert_that( job.done, is_( 2 ))
+		assert_that( b''.join( job.iter_result( chunk_size=4 ) ), is_( b'a,b\r\n1,2\r\n' ))
+
+		def _fail(unused_job):
+			raise ValueError( 'Bad' )
+
+		job = queue.submit( _fail )
+		self._wait( queue )
+		assert_that( job.state, is_( JOB_FAILED ))
+		assert_that( job.error, is_( 'Bad' ))
+		assert_that( queue.get( 'missing' ), none() )
+
+	def test_idempotent(self):
+		queue = LocalJobQueue( workers=1 )
+		started = Event()
+		release = Event()
+
+		def _block(unused_job):
+			started.set()
+			release.wait()
+
+		job = queue.submit( _block, job_id='job' )
+		started.wait()
+		assert_that( queue.submit( _block, job_id='job' ), same_instance( job ))
+		release.set()
+		self._wait( queue )
+		assert_that( job.state, is_( JOB_SUCCESS ))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+from hamcrest import contains_string
+from hamcrest import has_entries
+
+import unittest
+
+import transaction
+
+from zope import component
+
+from nti.app.analytics_registration.interfaces import IRegistrationMetrics
+
+from nti.app.analytics_registration.metrics import SUBMIT_RETRIES
+from nti.app.analytics_registration.metrics import SUBMIT_ATTEMPTS
+from nti.app.analytics_registration.metrics import SUBMIT_COMMITTED
+
+from nti.app.analytics_registration.metrics import to_prometheus
+from nti.app.analytics_registration.metrics import RegistrationMetrics
+from nti.app.analytics_registration.metrics import record_submit_attempt
+
+class _Request(object):
+
+	def __init__(self):
+		self.environ = {}
+
+class TestMetrics(unittest.TestCase):
+
+	def setUp(self):
+		self.metrics = RegistrationMetrics()
+		component.getGlobalSiteManager().registerUtility( self.metrics,
+														  IRegistrationMetrics )
+
+	def tearDown(self):
+		transaction.abort()
+		component.getGlobalSiteManager().unregisterUtility( self.metrics,
+															IRegistrationMetrics )
+
+	def test_retries(self):
+		request = _Request()
+		record_submit_attempt( request )
+		transaction.abort()
+		# The transaction loop runs the view again with the same request.
+		record_submit_attempt( request )
+		transaction.commit()
+		assert_that( self.metrics.snapshot(),
+					 has_entries( SUBMIT_ATTEMPTS, 2,
+								  SUBMIT_RETRIES, 1,
+								  SUBMIT_COMMITTED, 1 ))
+
+		self.metrics.clear()
+		assert_that( self.metrics.get( SUBMIT_ATTEMPTS ), is_( 0 ))
+
+	def test_prometheus(self):
+		self.metrics.incr( SUBMIT_ATTEMPTS )
+		self.metrics.observe( 'SubmitRegistration', 'storage', 0.25 )
+		self.metrics.observe( 'SubmitRegistration', 'storage', 0.5 )
+		text = to_prometheus( self.metrics )
+		assert_that( text, contains_string( 'nti_registration_submit_attempts_total 1\n' ))
+		assert_that( text, contains_string(
+			'nti_registration_view_phase_seconds_count{view="SubmitRegistration",phase="storage"} 2\n' ))
+		assert_that( text, contains_string(
+			'nti_registration_view_phase_seconds_sum{view="SubmitRegistration",phase="storage"} 0.750000\n' ))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import contains
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import raises
+
+import unittest
+
+from collections import namedtuple
+
+from datetime import datetime
+
+from nti.app.analytics_registration.ordering import WATERMARK_LAG
+
+from nti.app.analytics_registration.ordering import cap_watermark
+from nti.app.analytics_registration.ordering import encode_cursor
+from nti.app.analytics_registration.ordering import decode_cursor
+from nti.app.analytics_registration.ordering import parse_watermark
+from nti.app.analytics_registration.ordering import registrations_after
+from nti.app.analytics_registration.ordering import ordered_registrations
+from nti.app.analytics_registration.ordering import registration_sort_key
+
+_Registration = namedtuple( '_Registration', ('timestamp', 'user_registration_id') )
+
+class TestOrdering(unittest.TestCase):
+
+	def test_cursor(self):
+		registration = _Registration( datetime( 2016, 7, 25, 12, 30, 1, 5 ), 42 )
+		key = registration_sort_key( registration )
+		assert_that( decode_cursor( encode_cursor( key ) ), is_( key ))
+		assert_that( calling( decode_cursor ).with_args( 'bogus' ),
+					 raises( ValueError ))
+
+		assert_that( parse_watermark( encode_cursor( key ) ), is_( key ))
+		# Timestamps sort after every registration in that instant.
+		since = parse_watermark( '1469449801.000005' )
+		assert_that( since > key, is_( True ))
+		assert_that( since[0], is_( key[0] ))
+
+		for value in ('inf', '-inf', 'nan', '1e400'):
+			assert_that( calling( parse_watermark ).with_args( value ),
+						 raises( ValueError ))
+
+	def test_cap(self):
+		registration = _Registration( datetime( 2016, 7, 25, 12, 30, 1, 5 ), 42 )
+		key = registration_sort_key( registration )
+		now = key[0] / 1000000.0
+		# Registrations of the last WATERMARK_LAG seconds may still commit.
+		assert_that( cap_watermark( key, now ),
+					 is_( (key[0] - WATERMARK_LAG * 1000000, 0) ))
+		assert_that( cap_watermark( key, now + WATERMARK_LAG + 1 ), is_( key ))
+
+	def test_pages(self):
+		now = datetime( 2016, 7, 25 )
+		later = datetime( 2016, 7, 26 )
+		# Ties on timestamp are broken by id.
+		registrations = [_Registration( later, 1 ),
+						 _Registration( now, 3 ),
+						 _Registration( now, 2 )]
+		page = registrations_after( registrations, limit=2 )
+		assert_that( page, contains( registrations[2], registrations[1] ))
+
+		after = registration_sort_key( page[-1] )
+		page = registrations_after( registrations, after, limit=2 )
+		assert_that( page, contains( registrations[0] ))
+		assert_that( registrations_after( registrations ),
+					 contains( registrations[2], registrations[1], registrations[0] ))
+
+	def test_ordered(self):
+		now = datetime( 2016, 7, 25 )
+		later = datetime( 2016, 7, 26 )
+		registrations = [_Registration( later, 1 ),
+						 _Registration( now, 3 ),
+						 _Registration( now, 2 )]
+		result = ordered_registrations( tuple( registrations ) )
+		# Ties on timestamp are ordered by id, so the last is the watermark.
+		assert_that( result, contains( registrations[2], registrations[1], registrations[0] ))
+		since = registration_sort_key( result[1] )
+		assert_that( [x for x in result if registration_sort_key( x ) > since],
+					 contains( registrations[0] ))
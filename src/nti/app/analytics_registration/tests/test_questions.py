@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import assert_that
+
+import unittest
+
+from nti.app.analytics_registration.questions import LIST_ANSWER
+from nti.app.analytics_registration.questions import TEXT_ANSWER
+from nti.app.analytics_registration.questions import SurveyQuestionTypes
+
+class TestSurveyQuestionTypes(unittest.TestCase):
+
+	def test_types(self):
+		types = SurveyQuestionTypes()
+		assert_that( types.get( 'reg', 'survey list' ), none() )
+		assert_that( types.note( 'reg', {'survey list': [1, 2], 'survey_text': 'Jax'} ),
+					 is_( 2 ))
+		assert_that( types.get( 'reg', 'survey list' ), is_( LIST_ANSWER ))
+		assert_that( types.get( 'reg', 'survey_text' ), is_( TEXT_ANSWER ))
+		assert_that( types.list_questions( 'reg' ), is_( set( ['survey_list'] )))
+
+		# The first answer fixes the type.
+		assert_that( types.note( 'reg', {'survey list': 'one', 'survey_text': ['a']} ),
+					 is_( 0 ))
+		assert_that( types.list_questions( 'reg' ), is_( set( ['survey_list'] )))
+		assert_that( types.list_questions( 'other' ), is_( set() ))
@@ -10,6 +10,7 @@ __docformat__ = "restructuredtext en"
 from hamcrest import is_
 from hamcrest import none
 from hamcrest import is_not
+from hamcrest import contains
 from hamcrest import not_none
 from hamcrest import has_item
 from hamcrest import has_items
@@ -19,10 +20,14 @@ from hamcrest import has_entries
 from hamcrest import assert_that
 from hamcrest import has_property
 from hamcrest import has_properties
+from hamcrest import contains_string
+from hamcrest import same_instance
 does_not = is_not
 
 import os
 import csv
+import json
+import time
 
 from six import StringIO
 
@@ -35,6 +40,7 @@ from nti.app.testing.application_webtest import ApplicationLayerTest
 
 from nti.contenttypes.courses.interfaces import ICourseInstance
 from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
+from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
 
 from nti.contenttypes.courses.utils import get_enrollments
 
@@ -50,11 +56,27 @@ from nti.app.products.courseware.tests import InstructedCourseApplicationTestLay
 
 from nti.app.analytics_registration import REGISTRATION
 from nti.app.analytics_registration import REGISTRATION_READ_VIEW
+from nti.app.analytics_registration import REGISTRATION_STATS_VIEW
 from nti.app.analytics_registration import SUBMIT_REGISTRATION_INFO
 from nti.app.analytics_registration import REGISTRATION_ENROLL_RULES
+from nti.app.analytics_registration import REGISTRATION_PAGED_READ_VIEW
 from nti.app.analytics_registration import REGISTRATION_SURVEY_READ_VIEW
 from nti.app.analytics_registration import REGISTRATION_AVAILABLE_SESSIONS
 
+from nti.app.analytics_registration import ordering
+
+from nti.app.analytics_registration.admin_views import RegistrationCSVView
+
+from nti.app.analytics_registration.counters import get_registration_counters
+
+from nti.app.analytics_registration.courses import CourseResolver
+from nti.app.analytics_registration.courses import CourseLookupCache
+
+from nti.app.analytics_registration.enrollment import get_deferred_enrollment
+from nti.app.analytics_registration.enrollment import mark_deferred_enrollment
+
+from nti.app.analytics_registration.questions import get_survey_question_types
+
 from nti.analytics_registration.stats import _RegistrationStatsSource
 
 csv_update_values = '%s\n%s\n%s' % (
@@ -75,6 +97,8 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 	rules_url = '/dataserver2/%s/%s' % ( REGISTRATION, REGISTRATION_ENROLL_RULES )
 	registrations_url = '/dataserver2/%s/%s' % ( REGISTRATION, REGISTRATION_READ_VIEW )
 	registrations_survey_url = '/dataserver2/%s/%s' % ( REGISTRATION, REGISTRATION_SURVEY_READ_VIEW )
+	registrations_page_url = '/dataserver2/%s/%s' % ( REGISTRATION, REGISTRATION_PAGED_READ_VIEW )
+	registrations_stats_url = '/dataserver2/%s/%s' % ( REGISTRATION, REGISTRATION_STATS_VIEW )
 
 	registration_id = 'ClockmakersLie'
 
@@ -136,6 +160,17 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 				entry = ICourseCatalogEntry( course )
 				assert_that( entry.ntiid, is_( self.course_ntiid ))
 
+	def _wait_for_job(self, url, params, **kwargs):
+		"""
+		Poll the job status view until the job finishes.
+		"""
+		for unused in range( 100 ):
+			result = self.testapp.get( url, params=params, **kwargs ).json_body
+			if result.get( 'State' ) in ('Success', 'Failed'):
+				return result
+			time.sleep( 0.1 )
+		return result
+
 	@WithSharedApplicationMockDS(testapp=True, users=True)
 	def test_registration(self):
 		# Admin views
@@ -153,6 +188,35 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 		# Upload registration rules.
 		self._upload_rules( reg_params, get_rules_url, sessions=True, rules=True )
 
+		# Delta uploads of unchanged rules store nothing.
+		rules_csv = self._get_csv_data( 'course_rules.csv' )
+		res = self.testapp.post( self.rules_url,
+								 upload_files=[('rules', 'foo.csv', rules_csv)],
+								 params=dict( reg_params, delta='true' ))
+		assert_that( res.json_body, has_entries( 'Added', 0,
+												 'Removed', 0,
+												 'Unchanged', 1 ))
+
+		# Every invalid row is reported.
+		bad_rules = str( '%s\n%s\n%s\n%s\n' % ('School,Course,Grade,Course NTIID',
+												 'school,course,,ntiid',
+												 'school,course,6,ntiid',
+												 ',course,6,ntiid') )
+		res = self.testapp.post( self.rules_url,
+								 upload_files=[('rules', 'foo.csv', bad_rules)],
+								 params=reg_params,
+								 status=422 )
+		assert_that( res.json_body.get( 'Errors' ),
+					 contains( has_entry( 'line', 2 ), has_entry( 'line', 4 )))
+
+		# Conditional requests for unchanged rules are not modified.
+		res = self.testapp.get( get_rules_url, params=reg_params )
+		etag = res.headers.get( 'ETag' )
+		assert_that( etag, not_none() )
+		assert_that( res.headers.get( 'Last-Modified' ), not_none() )
+		self.testapp.get( get_rules_url, params=reg_params,
+						  headers={'If-None-Match': str( etag )}, status=304 )
+
 		# We can re-upload and still be valid
 		self._upload_rules( reg_params, get_rules_url, sessions=False, rules=True )
 		self._upload_rules( reg_params, get_rules_url, sessions=True, rules=False )
@@ -200,8 +264,40 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 
 		self._test_enrolled( 'sjohnson@nextthought.com' )
 
-		def _get_registrations_csv( url=self.registrations_url, reg_id=self.registration_id ):
+		status_url = '/dataserver2/users/sjohnson@nextthought.com/RegistrationEnrollmentStatus'
+		res = self.testapp.get( status_url, params=reg_params )
+		assert_that( res.json_body, has_entries( 'State', 'Success',
+												 'CourseNTIID', self.course_ntiid ))
+
+		# Polling does not enroll a dropped user again.
+		with mock_dataserver.mock_db_trans(self.ds, site_name='platform.ou.edu'):
+			course = ICourseInstance( find_object_with_ntiid( self.course_ntiid ) )
+			user = User.get_user( 'sjohnson@nextthought.com' )
+			ICourseEnrollmentManager( course ).drop( user )
+		self._test_enrolled( 'sjohnson@nextthought.com', enrolled=False )
+		res = self.testapp.get( status_url, params=reg_params )
+		assert_that( res.json_body, has_entries( 'State', 'Dropped',
+												 'CourseNTIID', self.course_ntiid ))
+		assert_that( res.json_body.get( 'Requeued' ), none() )
+		self._test_enrolled( 'sjohnson@nextthought.com', enrolled=False )
+
+		# A deferred enrollment lost without a job is queued again.
+		with mock_dataserver.mock_db_trans(self.ds, site_name='platform.ou.edu'):
+			user = User.get_user( 'sjohnson@nextthought.com' )
+			mark_deferred_enrollment( user, self.registration_id, self.course_ntiid )
+		res = self.testapp.get( status_url, params=reg_params )
+		assert_that( res.json_body, has_entries( 'Requeued', True,
+												 'CourseNTIID', self.course_ntiid ))
+		res = self._wait_for_job( status_url, reg_params )
+		assert_that( res, has_entry( 'State', 'Success' ))
+		self._test_enrolled( 'sjohnson@nextthought.com' )
+		with mock_dataserver.mock_db_trans(self.ds, site_name='platform.ou.edu'):
+			user = User.get_user( 'sjohnson@nextthought.com' )
+			assert_that( get_deferred_enrollment( user, self.registration_id ), none() )
+
+		def _get_registrations_csv( url=self.registrations_url, reg_id=self.registration_id, **kwargs ):
 			csv_params = {'registration_id':reg_id}
+			csv_params.update( kwargs )
 			res = self.testapp.get( url, params=csv_params )
 			return tuple( csv.DictReader( StringIO( res.body ) ) )
 
@@ -223,6 +319,19 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 		# Already registered.
 		self.testapp.post_json( submit_url, form_data, status=422 )
 
+		# Uploading the rules started the counts, which the submission
+		# changed in its own transaction.
+		with mock_dataserver.mock_db_trans(self.ds):
+			counters = get_registration_counters()
+			assert_that( counters.tracks( self.registration_id ), is_( True ))
+			assert_that( counters.get_counts( self.registration_id ),
+						 has_entry( 'total', has_entry( '', 1 )))
+		res = self.testapp.get( self.registrations_stats_url, params=reg_params )
+		assert_that( res.json_body, has_entries( 'Total', 1,
+												 'Maintained', True,
+												 'school', has_entry( self.school, 1 ),
+												 'session_range', has_entry( session, 1 )))
+
 		# Test db state
 		with mock_dataserver.mock_db_trans(self.ds):
 			# Empty
@@ -243,6 +352,9 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 															'response', list_response ),
 											has_properties( 'question_id', 'survey_text',
 															'response', text_response ) ))
+			# Typed exports give only the list question a list column.
+			assert_that( get_survey_question_types().list_questions( self.registration_id ),
+						 is_( set( ['survey_list'] )))
 
 		# Two users, two different sessions; form_data2 has new session, reg_id, version.
 		registration_id2 = 'Registration2'
@@ -267,6 +379,46 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 		self._test_enrolled( new_username )
 		self.testapp.post_json( submit_url2, form_data2, extra_environ=new_user_env )
 
+		# Counts are kept as registrations are submitted, without a rebuild.
+		with mock_dataserver.mock_db_trans(self.ds):
+			counts = get_registration_counters().get_counts( self.registration_id )
+			assert_that( counts, has_entries( 'total', has_entry( '', 2 ),
+											  'session_range', has_entry( session, 2 )))
+		res = self.testapp.get( self.registrations_stats_url, params=reg_params )
+		assert_that( res.json_body, has_entries( 'Total', 2,
+												 'session_range', has_entry( session, 2 )))
+		# A POST recounts the stored registrations.
+		res = self.testapp.post( self.registrations_stats_url, params=reg_params )
+		assert_that( res.json_body, has_entries( 'Total', 2, 'Maintained', True ))
+
+		# Submissions are counted.
+		res = self.testapp.get( '/dataserver2/registration/RegistrationMetrics' )
+		assert_that( res.json_body.get( 'Items' ), has_entry( 'submit.committed', not_none() ))
+		assert_that( res.json_body.get( 'Timings' ),
+					 has_entry( SUBMIT_REGISTRATION_INFO, has_entry( 'storage', not_none() )))
+		res = self.testapp.get( '/dataserver2/registration/RegistrationMetrics',
+								params={'format': 'prometheus'} )
+		assert_that( res.body, contains_string( 'nti_registration_view_phase_seconds' ))
+
+		# Both registrations take a seat in a session with a capacity.
+		sessions_csv = self._get_csv_data( 'course_sessions.csv' ).splitlines()
+		sessions_csv = [x + ',2' if session in x else x for x in sessions_csv]
+		self.testapp.post( self.sessions_url,
+						   upload_files=[('sessions', 'foo.csv', '\n'.join( sessions_csv ))],
+						   params=dict( reg_params, delta='true' ))
+		res = self.testapp.get( get_rules_url, params=reg_params )
+		assert_that( res.json_body.get( 'RemainingSeats' ),
+					 has_entry( self.course_ntiid, has_entry( session, 0 )))
+
+		# Delta uploads store a changed curriculum.
+		renamed_csv = [x.replace( 'Lunar Colony', 'Lunar Base' ) if session in x else x
+					   for x in sessions_csv]
+		for upload in (renamed_csv, sessions_csv):
+			res = self.testapp.post( self.sessions_url,
+									 upload_files=[('sessions', 'foo.csv', '\n'.join( upload ))],
+									 params=dict( reg_params, delta='true' ))
+			assert_that( res.json_body, has_entries( 'Added', 1, 'Removed', 1 ))
+
 		# CSVs
 		csv_output = _get_registrations_csv()
 		assert_that( csv_output, has_length( 2 ))
@@ -295,12 +447,86 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 												 'Survey: survey_text', '',
 												 'Survey: survey_list', '' )))
 
+		# Streaming returns the same rows, built in the streaming
+		# transaction as the response is written, a batch per registration.
+		RegistrationCSVView._batch_size = 1
+		try:
+			for url in (self.registrations_url, self.registrations_survey_url):
+				expected = _get_registrations_csv( url=url )
+				assert_that( expected, has_length( 2 ))
+				streamed = _get_registrations_csv( url=url, stream='true' )
+				assert_that( streamed, is_( expected ))
+			ndjson_params = {'registration_id': self.registration_id,
+							 'format': 'ndjson'}
+			expected = self.testapp.get( self.registrations_survey_url,
+										 params=ndjson_params ).body
+			streamed = self.testapp.get( self.registrations_survey_url,
+										 params=dict( ndjson_params, stream='true' )).body
+			assert_that( streamed, is_( expected ))
+		finally:
+			del RegistrationCSVView._batch_size
+
+		# Watermarks of recent registrations are capped, so they may be
+		# exported again rather than skipped if others commit late.
+		res = self.testapp.get( self.registrations_url, params=reg_params )
+		watermark = res.headers.get( 'X-Registration-Watermark' )
+		assert_that( watermark, not_none() )
+		assert_that( _get_registrations_csv( since=watermark ), has_length( 2 ))
+
+		# Exports since a watermark only include later registrations.
+		lag = ordering.WATERMARK_LAG
+		ordering.WATERMARK_LAG = 0
+		try:
+			res = self.testapp.get( self.registrations_url, params=reg_params )
+		finally:
+			ordering.WATERMARK_LAG = lag
+		watermark = res.headers.get( 'X-Registration-Watermark' )
+		csv_output = _get_registrations_csv( since=watermark )
+		assert_that( csv_output, has_length( 0 ))
+		assert_that( _get_registrations_csv( since='0' ), has_length( 2 ))
+		self.testapp.get( self.registrations_url,
+						  params=dict( reg_params, since='inf' ),
+						  status=422 )
+
+		# NDJSON keeps list responses.
+		res = self.testapp.get( self.registrations_survey_url,
+								params={'registration_id': self.registration_id,
+										'format': 'ndjson'} )
+		records = [json.loads( x ) for x in res.body.splitlines()]
+		assert_that( records, has_length( 2 ))
+		assert_that( records, has_item(
+									has_entries( 'username', 'sjohnson@nextthought.com',
+												 'Survey: survey_list', list_response )))
+
+		# Page through registrations as JSON.
+		page_params = {'registration_id': self.registration_id, 'batchSize': 1}
+		page = self.testapp.get( self.registrations_page_url, params=page_params ).json_body
+		assert_that( page, has_entries( 'ItemCount', 1, 'Next', not_none() ))
+		first_username = page['Items'][0]['username']
+		page_params['after'] = page['Next']
+		page = self.testapp.get( self.registrations_page_url, params=page_params ).json_body
+		assert_that( page, has_entries( 'ItemCount', 1, 'Next', none() ))
+		assert_that( page['Items'][0]['username'], is_not( first_username ))
+		page_params['after'] = 'bogus'
+		self.testapp.get( self.registrations_page_url, params=page_params, status=422 )
+
 		# Test stats
 		with mock_dataserver.mock_db_trans(self.ds, site_name='platform.ou.edu'):
 			course = find_object_with_ntiid( self.course_ntiid )
 			course = ICourseInstance( course )
 			subs = component.subscribers( (user, course), IAnalyticsStatsSource )
 			subs = [x for x in subs if isinstance(x, _RegistrationStatsSource)]
+
+			# Courses are resolved once per resolver, and can be
+			# reloaded by identity.
+			resolver = CourseResolver()
+			lookup = resolver.resolve( self.course_ntiid )
+			assert_that( lookup.course, is_( course ))
+			assert_that( resolver.resolve( self.course_ntiid ), same_instance( lookup ))
+			lookup_cache = CourseLookupCache()
+			lookup_cache.set( self.course_ntiid, course )
+			assert_that( lookup_cache.get( self.course_ntiid, course._p_jar ),
+						 same_instance( course ))
 			assert_that( subs, has_length( 1 ))
 			stats = subs[0]
 			# We have multiple records mapping to the same course
@@ -316,9 +542,24 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 
 		# Update user information
 		update_url = '/dataserver2/registration/UpdateRegistrations'
-		self.testapp.post( update_url,
-						   upload_files=[('input', 'foo.csv', csv_update_values)],
-						   params=reg_params)
+		res = self.testapp.post( update_url,
+								 upload_files=[('input', 'foo.csv', csv_update_values)],
+								 params=dict( reg_params, dry_run='true' ))
+		assert_that( res.json_body, has_entries( 'DryRun', True,
+												 'Updated', ['sjohnson@nextthought.com'],
+												 'Changes', has_entry( 'sjohnson@nextthought.com',
+																	   has_item( has_entry( 'phone', [None, 'new_phone'] )))))
+		with mock_dataserver.mock_db_trans(self.ds):
+			user = User.get_user( 'sjohnson@nextthought.com' )
+			user_registrations = get_user_registrations( user, self.registration_id )
+			assert_that( user_registrations[0].phone, none() )
+
+		res = self.testapp.post( update_url,
+								 upload_files=[('input', 'foo.csv', csv_update_values)],
+								 params=reg_params)
+		assert_that( res.json_body, has_entries( 'Updated', ['sjohnson@nextthought.com'],
+												 'Skipped', has_length( 0 ),
+												 'Missing', has_length( 0 )))
 
 		with mock_dataserver.mock_db_trans(self.ds):
 			# User is now updated.
@@ -333,6 +574,13 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 			assert_that( user_registration.phone, is_( 'new_phone' ))
 			assert_that( user_registration.session_range, is_( 'new_range' ))
 
+		# Re-applying the same values changes nothing.
+		res = self.testapp.post( update_url,
+								 upload_files=[('input', 'foo.csv', csv_update_values)],
+								 params=reg_params)
+		assert_that( res.json_body, has_entries( 'Updated', has_length( 0 ),
+												 'Unchanged', ['sjohnson@nextthought.com'] ))
+
 		# Test admin view removing registrations
 		delete_url = '/dataserver2/registration/RemoveRegistrations'
 
@@ -367,3 +615,77 @@ class TestAnalyticsRegistration(ApplicationLayerTest):
 									has_entries( 'username', new_username,
 												 'session_range', session2 )))
 
+
+		# Remove in batches of users, in the background.
+		res = self.testapp.post_json( delete_url, {'registration_id': registration_id2,
+												   'batchSize': 1},
+									  status=202 )
+		job_id = res.json_body['JobId']
+		res = self._wait_for_job( '/dataserver2/registration/RegistrationRemovalStatus',
+								  {'job_id': job_id} )
+		assert_that( res, has_entries( 'State', 'Success',
+									   'Users', 1,
+									   'Deleted', 1,
+									   'Unenrolled', 1,
+									   'Batches', contains( has_entries( 'Users', 1,
+																		 'Deleted', 1,
+																		 'Unenrolled', 1 ))))
+		self._test_enrolled( new_username, enrolled=False )
+		self.testapp.get( self.registrations_url,
+						  params={'registration_id': registration_id2},
+						  status=404 )
+
+		# Imports validate every row against the rules up front.
+		import_csv = str( '%s\n%s\n' % ('username,school,grade,course,session,employee_id',
+										'%s,HardKnocks,6,%s,%s,id' % (new_username,
+																	  self.course_ntiid,
+																	  session)) )
+		res = self.testapp.post( '/dataserver2/registration/ImportRegistrations',
+								 upload_files=[('input', 'import.csv', import_csv)],
+								 params={'registration_id': registration_id2},
+								 status=422 )
+		assert_that( res.json_body.get( 'Errors' ),
+					 contains( has_entries( 'line', 2, 'username', new_username )))
+
+		# Valid rows are stored in the background; sessions not in the
+		# uploaded sessions are allowed, as with submissions.
+		import_csv = str( '%s\n%s\n%s\n' % ('username,school,grade,course,session,employee_id,survey_text',
+											   '%s,"%s",6,"%s",%s,id,Imported' % (new_username,
+																				 self.school,
+																				 self.course_ntiid,
+																				 session2),
+											   'sjohnson@nextthought.com,"%s",6,"%s",%s,id2,' % (self.school,
+																								  self.course_ntiid,
+																								  session)) )
+		res = self.testapp.post( '/dataserver2/registration/ImportRegistrations',
+								 upload_files=[('input', 'import.csv', import_csv)],
+								 params={'registration_id': registration_id2},
+								 status=202 )
+		assert_that( res.json_body.get( 'Errors' ), has_length( 0 ))
+		res = self._wait_for_job( '/dataserver2/registration/RegistrationImportStatus',
+								  {'job_id': res.json_body['JobId']} )
+		assert_that( res, has_entries( 'State', 'Success',
+									   'Stored', 2,
+									   'Errors', has_length( 0 )))
+
+		csv_output = _get_registrations_csv( reg_id=registration_id2 )
+		assert_that( csv_output, has_length( 2 ))
+		assert_that( csv_output, has_items(
+									has_entries( 'username', new_username,
+												 'session_range', session2,
+												 'employee_id', 'id' ),
+									has_entries( 'username', 'sjohnson@nextthought.com',
+												 'session_range', session,
+												 'employee_id', 'id2' )))
+
+		# A batch failing to store is retried by row, reporting each row.
+		res = self.testapp.post( '/dataserver2/registration/ImportRegistrations',
+								 upload_files=[('input', 'import.csv', import_csv)],
+								 params={'registration_id': registration_id2},
+								 status=202 )
+		res = self._wait_for_job( '/dataserver2/registration/RegistrationImportStatus',
+								  {'job_id': res.json_body['JobId']} )
+		assert_that( res, has_entries( 'State', 'Success',
+									   'Stored', 0,
+									   'Errors', has_length( 2 )))
+		assert_that( _get_registrations_csv( reg_id=registration_id2 ), has_length( 2 ))
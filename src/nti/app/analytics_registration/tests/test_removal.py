@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import contains
+from hamcrest import has_entries
+from hamcrest import assert_that
+
+import unittest
+
+from collections import namedtuple
+
+from zope import component
+from zope import interface
+
+from nti.app.analytics_registration import removal
+
+from nti.app.analytics_registration.removal import RegistrationRemover
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+_User = namedtuple( '_User', ('username',) )
+_Registration = namedtuple( '_Registration', ('user',) )
+
+@interface.implementer(IDataserverTransactionRunner)
+class _Runner(object):
+
+	def __init__(self):
+		self.transactions = 0
+
+	def __call__(self, func, site_names=(), side_effect_free=False):
+		self.transactions += 1
+		return func()
+
+class _Job(object):
+	total = None
+	done = 0
+	result = None
+
+class TestRegistrationRemover(unittest.TestCase):
+
+	def setUp(self):
+		self.runner = _Runner()
+		component.getGlobalSiteManager().registerUtility( self.runner,
+														  IDataserverTransactionRunner )
+		users = [_User( x ) for x in ('c', 'a', 'b')]
+		# A user may have several registrations of the registration id.
+		self.registrations = [_Registration( x ) for x in users + users[:1]]
+		self.deleted = []
+		self._patched = {}
+		self._patch( 'get_user_registrations', lambda unused_user, unused_id: self.registrations )
+		self._patch( 'User', type( str( '_Users' ), (object,),
+								   {'get_user': staticmethod( _User )} ))
+		self._patch( 'delete_user_registrations', self._delete )
+		self._patch( 'uncount_registrations', lambda *unused: None )
+		self._patch( 'unenroll_registrations',
+					 lambda deleted: len( set( x.user for x, unused in deleted )))
+
+	def tearDown(self):
+		for name, value in self._patched.items():
+			setattr( removal, name, value )
+		component.getGlobalSiteManager().unregisterUtility( self.runner,
+															IDataserverTransactionRunner )
+
+	def _patch(self, name, value):
+		self._patched[name] = getattr( removal, name )
+		setattr( removal, name, value )
+
+	def _delete(self, user, unused_registration_id):
+		result = [(x, 'ntiid') for x in self.registrations if x.user == user]
+		self.deleted.extend( result )
+		return result
+
+	def test_batches(self):
+		job = _Job()
+		RegistrationRemover( 'reg', 2 )( job )
+		assert_that( job.total, is_( 3 ))
+		assert_that( job.done, is_( 3 ))
+		# One transaction to list the users, then one per batch.
+		assert_that( self.runner.transactions, is_( 3 ))
+		assert_that( job.result,
+					 has_entries( 'Users', 3,
+								  'Deleted', 4,
+								  'Unenrolled', 3,
+								  'Batches', contains( has_entries( 'Users', 2,
+																	'Deleted', 2,
+																	'Unenrolled', 2 ),
+													   has_entries( 'Users', 1,
+																	'Deleted', 2,
+																	'Unenrolled', 1 ))))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import same_instance
+
+import unittest
+
+from collections import namedtuple
+
+from zope import component
+
+from nti.app.analytics_registration import rules
+
+from nti.app.analytics_registration.interfaces import IRegistrationRuleIndexCache
+
+from nti.app.analytics_registration.rules import get_rule_index
+from nti.app.analytics_registration.rules import RegistrationRuleIndex
+from nti.app.analytics_registration.rules import RegistrationRuleIndexCache
+
+_Rule = namedtuple( '_Rule', ('school', 'grade_teaching', 'curriculum', 'course_ntiid') )
+_Session = namedtuple( '_Session', ('curriculum', 'session_range', 'course_ntiid') )
+
+class TestRuleIndex(unittest.TestCase):
+
+	def test_index(self):
+		index = RegistrationRuleIndex( (_Rule( 'school', '6', 'course', 'ntiid' ),),
+									   (_Session( 'course', 'June', 'ntiid' ),) )
+		# Grades may be submitted as numbers.
+		assert_that( index.is_valid_course( 'school', 6, 'ntiid' ), is_( True ))
+		assert_that( index.is_valid_course( 'school', 7, 'ntiid' ), is_( False ))
+		assert_that( index.is_valid_course( 'other', 6, 'ntiid' ), is_( False ))
+		assert_that( index.is_valid_session( 'ntiid', 'June' ), is_( True ))
+		assert_that( index.is_valid_session( 'ntiid', 'July' ), is_( False ))
+		assert_that( index.get_curriculum( 'school', 6, 'ntiid' ), is_( 'course' ))
+		assert_that( index.get_curriculum( 'school', 7, 'ntiid' ), none() )
+
+	def test_cache(self):
+		cache = RegistrationRuleIndexCache()
+		index = RegistrationRuleIndex( version=1 )
+		cache.set( 'reg', index )
+		assert_that( cache.get( 'reg', 1 ), same_instance( index ))
+		# Rules stored since, by any process, have a new version.
+		assert_that( cache.get( 'reg', 2 ), none() )
+		cache.invalidate( 'reg' )
+		assert_that( cache.get( 'reg', 1 ), none() )
+
+	def test_versions(self):
+		cache = RegistrationRuleIndexCache()
+		# Cached before these rules were stored by another process.
+		cache.set( 'reg', RegistrationRuleIndex( version=1 ) )
+		stored = (_Rule( 'school', '6', 'course', 'ntiid' ),)
+		built = []
+		def _build(registration_id, version=None):
+			built.append( version )
+			return RegistrationRuleIndex( stored, version=version )
+		gsm = component.getGlobalSiteManager()
+		gsm.registerUtility( cache, IRegistrationRuleIndexCache )
+		build_rule_index = rules.build_rule_index
+		get_rules_version = rules.get_rules_version
+		rules.build_rule_index = _build
+		rules.get_rules_version = lambda unused: 2
+		try:
+			index = get_rule_index( 'reg' )
+			assert_that( index.is_valid_course( 'school', 6, 'ntiid' ), is_( True ))
+			assert_that( cache.get( 'reg', 2 ), same_instance( index ))
+			# Rejections are answered by the current index, without a rebuild.
+			assert_that( get_rule_index( 'reg' ).is_valid_course( 'school', 7, 'ntiid' ),
+						 is_( False ))
+			assert_that( built, has_length( 1 ))
+		finally:
+			rules.build_rule_index = build_rule_index
+			rules.get_rules_version = get_rules_version
+			gsm.unregisterUtility( cache, IRegistrationRuleIndexCache )
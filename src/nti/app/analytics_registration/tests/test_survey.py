@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import assert_that
+
+import unittest
+
+from nti.app.analytics_registration.survey import SurveyColumnLayout
+
+class TestSurveyColumnLayout(unittest.TestCase):
+
+	def test_layout(self):
+		layout = SurveyColumnLayout( ('survey text', 'survey_list') )
+		assert_that( layout.columns, is_( ['Survey: survey text', 'Survey: survey_list'] ))
+
+		details = [('survey_list', [1, 2]), ('survey text', 'Jax')]
+		assert_that( layout.build_row( 'v1', details ),
+					 is_( ['v1', 'Jax', '1, 2'] ))
+		assert_that( layout.build_row( 'v1', details, join_lists=False ),
+					 is_( ['v1', 'Jax', [1, 2]] ))
+		assert_that( layout.build_row( None, () ), is_( [None, '', ''] ))
+		assert_that( layout.stale, is_( False ))
+
+		layout.build_row( 'v2', [('new question', 'yes')] )
+		assert_that( layout.stale, is_( True ))
@@ -9,7 +9,11 @@ __docformat__ = "restructuredtext en"
 
 logger = __import__('logging').getLogger(__name__)
 
-import nameparser
+import csv
+
+from collections import namedtuple
+
+from io import BytesIO
 
 from requests.structures import CaseInsensitiveDict
 
@@ -17,18 +21,78 @@ from zope import component
 
 from zope.cachedescriptors.property import Lazy
 
+from nti.analytics_registration.registration import get_user_registrations
 from nti.analytics_registration.registration import get_all_survey_questions
 
 from nti.app.analytics_registration import MessageFactory as _
 
+from nti.app.analytics_registration.caches import parse_name
+
+from nti.app.analytics_registration.instrumentation import PHASE_USER_LOOKUP
+
+from nti.app.analytics_registration.instrumentation import time_phase
+
+from nti.app.analytics_registration.interfaces import INameParserCache
+from nti.app.analytics_registration.interfaces import IRegistrationJobQueue
+
+from nti.app.analytics_registration.ordering import ordered_registrations
+
+from nti.app.analytics_registration.survey import SurveyColumnLayout
+
+from nti.app.externalization.error import raise_json_error
+
 from pyramid import httpexceptions as hexc
 
+from nti.common.string import is_true
+
+from nti.dataserver.interfaces import IUser
 from nti.dataserver.interfaces import IUsernameSubstitutionPolicy
 
 from nti.dataserver.users import User
 
 from nti.dataserver.users.interfaces import IUserProfile
 
+from nti.externalization.interfaces import LocatedExternalDict
+from nti.externalization.interfaces import StandardExternalFields
+
+CLASS = StandardExternalFields.CLASS
+
+#: The number of CSV rows written between each yielded chunk.
+CSV_STREAM_BATCH_SIZE = 500
+
+#: The user information needed for a registration row.
+ResolvedRegistrationUser = namedtuple( 'ResolvedRegistrationUser',
+									   ('username',
+										'first_name',
+										'last_name',
+										'email',
+										'account_create_date',
+										'last_login_time'))
+
+def batched(items, batch_size=CSV_STREAM_BATCH_SIZE):
+	"""
+	Yield lists of at most `batch_size` items from the given iterable.
+	"""
+	batch = []
+	for item in items:
+		batch.append( item )
+		if len( batch ) >= batch_size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+def build_row_values(registration_header, line_data, layout=None, survey=None):
+	"""
+	The CSV values of a row: the registration columns in header order,
+	followed by the survey columns when given a survey layout.
+	"""
+	result = [line_data.get( x ) for x in registration_header]
+	if layout is not None:
+		survey_version, details = survey
+		result.extend( layout.build_row( survey_version, details ) )
+	return result
 
 def replace_username(username):
 	substituter = component.queryUtility(IUsernameSubstitutionPolicy)
@@ -69,34 +133,74 @@ class RegistrationIDViewMixin(object):
 
 		realname = profile.realname or ''
 		if realname and '@' not in realname and realname != username:
-			human_name = nameparser.HumanName(realname)
-			firstname = human_name.first or ''
-			lastname = human_name.last or ''
+			name_cache = component.queryUtility( INameParserCache )
+			if name_cache is not None:
+				firstname, lastname = name_cache.parse( realname )
+			else:
+				firstname, lastname = parse_name( realname )
 		else:
 			firstname = ''
 			lastname = ''
 		email = getattr( profile, 'email', '' )
 		return external_id, firstname, lastname, email
 
+	@Lazy
+	def _resolved_users(self):
+		"""
+		Resolved user information by username, for this request.
+		"""
+		return {}
+
+	def _resolve_user(self, registration_user):
+		username = registration_user.username
+		# The registration usually hands us the user object already.
+		user = registration_user
+		if not IUser.providedBy( user ):
+			user = User.get_user( username )
+		if user is None:
+			logger.warn( 'User not found (%s)', username )
+			return None
+		external_id, first, last, email = self._get_names_and_email( user, username )
+		return ResolvedRegistrationUser( external_id,
+										 first,
+										 last,
+										 email,
+										 getattr( user, 'created', None ),
+										 getattr( user, 'lastLoginTime', None ) )
+
+	def _resolve_registration_users(self, registrations):
+		"""
+		Resolve the users, profiles, names and emails for a batch of
+		registrations in one pass. Each user is only resolved once per
+		request, regardless of how many registrations they have.
+		"""
+		resolved = self._resolved_users
+		with time_phase( self.request, PHASE_USER_LOOKUP ):
+			for registration in registrations:
+				registration_user = registration.user
+				if not registration_user:
+					continue
+				username = registration_user.username
+				if username not in resolved:
+					resolved[username] = self._resolve_user( registration_user )
+		return resolved
+
 	def _get_registration_row_data(self, registration):
 		if not registration.user:
 			logger.warn( 'User no longer exists' )
 			return
-		username = registration.user.username
-		user = User.get_user( username )
-		if user is None:
-			logger.warn( 'User not found (%s)', username )
+		resolved = self._resolve_registration_users( (registration,) )
+		user_info = resolved.get( registration.user.username )
+		if user_info is None:
 			return
-		username, first, last, email = self._get_names_and_email( user, username )
+		email = user_info.email
 		if email and email.endswith( '@nextthought.com' ):
 			return
-		account_create_date = getattr( user, 'created', None )
-		last_login = getattr( user, 'lastLoginTime', None )
-		line_data = {'username': username,
-					 'first_name': first,
-					 'last_name': last,
-					 'account_create_date': account_create_date,
-					 'last_login_time': last_login,
+		line_data = {'username': user_info.username,
+					 'first_name': user_info.first_name,
+					 'last_name': user_info.last_name,
+					 'account_create_date': user_info.account_create_date,
+					 'last_login_time': user_info.last_login_time,
 					 'registration_date': registration.timestamp,
 					 'employee_id': registration.employee_id,
 					 'email': email,
@@ -107,7 +211,158 @@ class RegistrationIDViewMixin(object):
 					 'curriculum': registration.curriculum}
 		return line_data
 
+class RegistrationCSVUploadMixin( object ):
+	"""
+	A mixin to validate uploaded CSV rows as they are read, collecting
+	every row-level error rather than stopping at the first.
+	"""
+
+	def _iter_upload_rows(self, source, factory, errors, optional=0):
+		"""
+		Yield a `factory` tuple for each valid row in the CSV source,
+		skipping the header, comments and blank lines. Each invalid row is
+		appended to `errors` along with its line number.
+
+		The last `optional` fields may be blank or missing, and are given
+		as None. A factory may raise a ValueError for invalid values.
+		"""
+		field_count = len( factory._fields )
+		required_count = field_count - optional
+		csv_input = csv.reader( source )
+		# Skip header
+		next( csv_input, None )
+		for row in csv_input:
+			if not row or row[0].startswith("#") or not ''.join( row ).strip():
+				continue
+			values = row[:field_count]
+			required = values[:required_count]
+			if len( required ) < required_count or not all( required ):
+				errors.append( {'line': csv_input.line_num,
+								'message': 'Line with missing data',
+								'row': row} )
+				continue
+			values = [x or None for x in values[required_count:]]
+			values += [None] * (field_count - len( required ) - len( values ))
+			try:
+				result = factory( *(required + values) )
+			except ValueError as e:
+				errors.append( {'line': csv_input.line_num,
+								'message': '%s' % e,
+								'row': row} )
+				continue
+			yield result
+
+	def _is_delta(self, values):
+		"""
+		Whether the upload should only be stored if it differs from the
+		rows already stored.
+		"""
+		params = CaseInsensitiveDict( self.request.params )
+		return is_true( values.get( 'delta' ) or params.get( 'delta' ) )
+
+	def _get_upload_delta(self, uploaded_keys, stored_keys):
+		"""
+		Compare the keys of the uploaded and stored rows, returning
+		the counts of added, removed and unchanged rows.
+		"""
+		uploaded_keys = set( uploaded_keys )
+		stored_keys = set( stored_keys )
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationUploadDelta'
+		result['Added'] = len( uploaded_keys - stored_keys )
+		result['Removed'] = len( stored_keys - uploaded_keys )
+		result['Unchanged'] = len( uploaded_keys & stored_keys )
+		return result
+
+	def _raise_upload_errors(self, errors):
+		raise_json_error( self.request,
+						  hexc.HTTPUnprocessableEntity,
+						  {'message': _('Invalid rows in CSV input.'),
+						   'code': 'InvalidRegistrationCSV',
+						   'Errors': errors},
+						  None )
+
 class RegistrationCSVMixin( object ):
+	"""
+	Builds registration CSV rows; expects to be combined with a
+	:class:`RegistrationIDViewMixin`.
+	"""
+
+	#: The number of rows built and written per batch.
+	_batch_size = CSV_STREAM_BATCH_SIZE
+
+	def _get_registrations(self, username, registration_id):
+		"""
+		The registrations to export, in timestamp order.
+		"""
+		user = User.get_user( username ) if username else None
+		registrations = get_user_registrations( user, registration_id )
+		if not registrations:
+			return ()
+		return ordered_registrations( registrations )
+
+	def _get_header_row(self):
+		return self._get_registration_header_row()
+
+	def _get_row_data(self, registration):
+		return self._get_registration_row_data( registration )
+
+	def _get_survey_layout(self):
+		return None
+
+	def _get_record(self, registration):
+		"""
+		The data of a registration, keeping native values (such as list
+		survey responses) for typed export formats.
+		"""
+		return self._get_registration_row_data( registration )
+
+	def _iter_row_data(self, registrations, row_factory=None):
+		row_factory = row_factory or self._get_row_data
+		for batch in batched( registrations, self._batch_size ):
+			# Resolve the users for the whole batch before building rows.
+			self._resolve_registration_users( batch )
+			for registration in batch:
+				line_data = row_factory( registration )
+				if line_data:
+					yield line_data
+
+	def _drain_stream(self, stream):
+		result = stream.getvalue()
+		stream.seek( 0 )
+		stream.truncate()
+		return result
+
+	def _iter_csv(self, header_row, rows, batch_size=None):
+		"""
+		Write the given rows (dicts, or lists in header order) as CSV,
+		yielding the encoded output in chunks of `batch_size` rows. The
+		header is yielded on its own so clients receive it before any row
+		data is built.
+		"""
+		batch_size = batch_size or self._batch_size
+		stream = BytesIO()
+		csv_writer = csv.DictWriter( stream, header_row )
+		csv_writer.writeheader()
+		yield self._drain_stream( stream )
+
+		count = 0
+		for line_data in rows:
+			if isinstance( line_data, dict ):
+				csv_writer.writerow( line_data )
+			else:
+				# Rows already in header order.
+				csv_writer.writer.writerow( line_data )
+			count += 1
+			if count >= batch_size:
+				yield self._drain_stream( stream )
+				count = 0
+		if count:
+			yield self._drain_stream( stream )
+
+	@Lazy
+	def _registration_header_row(self):
+		return self._get_registration_header_row()
 
 	def _get_registration_header_row(self):
 		header_row = [u'username', u'first_name', u'last_name',
@@ -119,48 +374,90 @@ class RegistrationCSVMixin( object ):
 
 class RegistrationSurveyCSVMixin(RegistrationCSVMixin):
 
-	def _get_question_key(self, question_id):
-		# Remove whitespace
-		return '_'.join( question_id.split() )
-
-	def _get_survey_display(self, question_id):
-		return 'Survey: %s' % question_id
-
 	@Lazy
-	def _survey_question_map(self):
+	def _survey_layout(self):
 		"""
-		Map survey question identifier to display version.
+		The survey columns of this registration id, built once per export
+		from the current survey questions.
 		"""
-		registration_id = self._get_registration_id()
-		survey_questions = get_all_survey_questions( registration_id )
-		survey_question_map = {self._get_question_key( x ): self._get_survey_display( x )
-							   for x in survey_questions}
-		return survey_question_map
+		survey_questions = get_all_survey_questions( self._get_registration_id() )
+		return SurveyColumnLayout( survey_questions )
+
+	def _get_survey_layout(self):
+		return self._survey_layout
 
 	def _get_registration_survey_header_row(self):
 		header_row = []
 		header_row.append( 'survey_version' )
-		questions = sorted( self._survey_question_map.values() )
-		header_row.extend( questions )
+		header_row.extend( self._survey_layout.columns )
 		return header_row
 
-	def _get_registration_survey_row_data(self, registration):
-		line_data = {}
+	def _get_header_row(self):
+		result = []
+		result.extend( self._get_registration_header_row() )
+		result.extend( self._get_registration_survey_header_row() )
+		return result
+
+	def _get_row_data(self, registration):
+		registration_data = self._get_registration_row_data( registration )
+		if not registration_data:
+			return None
+		return build_row_values( self._registration_header_row,
+								 registration_data,
+								 self._survey_layout,
+								 self._get_survey_snapshot( registration ) )
+
+	def _get_survey_snapshot(self, registration):
+		"""
+		The survey version and (question_id, response) pairs of the
+		registration's survey submission.
+		"""
 		survey_submission = registration.survey_submission[0]
-		line_data['survey_version'] = survey_submission.survey_version
-
-		# Gather our user responses
-		user_results = {}
-		for submission in survey_submission.details:
-			key = self._get_question_key( submission.question_id )
-			response = submission.response
-			if isinstance( response, list ):
-				# Make sure our list response is readable.
-				response = ', '.join( (str(x) for x in response) )
-			user_results[ key ] = response
-
-		# Now map to our result set, making sure to provide empty string
-		# for no-responses.
-		for key, display in self._survey_question_map.items():
-			line_data[display] = user_results.get( key, '' )
-		return line_data
+		details = [(x.question_id, x.response) for x in survey_submission.details]
+		return survey_submission.survey_version, details
+
+	def _get_registration_survey_row_data(self, registration, join_lists=True):
+		survey_version, details = self._get_survey_snapshot( registration )
+		values = self._survey_layout.build_row( survey_version, details, join_lists )
+		return dict( zip( self._get_registration_survey_header_row(), values ) )
+
+	def _get_record(self, registration):
+		record = self._get_registration_row_data( registration )
+		if record:
+			survey_data = self._get_registration_survey_row_data( registration,
+																  join_lists=False )
+			record.update( survey_data )
+		return record
+
+class RegistrationJobViewMixin( object ):
+	"""
+	A mixin for views reporting on queued registration jobs. Jobs are
+	only known to the process that queued them; requests reaching another
+	process get a 404.
+	"""
+
+	@Lazy
+	def _job_queue(self):
+		return component.getUtility( IRegistrationJobQueue )
+
+	def _get_job(self):
+		"""
+		The job named by the `job_id` param, raising a 404 if not found.
+		"""
+		params = CaseInsensitiveDict( self.request.params )
+		job_id = params.get( 'job_id' ) or params.get( 'JobId' )
+		job = self._job_queue.get( job_id ) if job_id else None
+		if job is None:
+			raise hexc.HTTPNotFound( _('Job not found in this server process.') )
+		return job
+
+	def _job_to_external(self, job, class_name='RegistrationJob'):
+		result = LocatedExternalDict()
+		result[CLASS] = class_name
+		result['JobId'] = job.id
+		result['Owner'] = job.owner
+		result['State'] = job.state
+		result['Total'] = job.total
+		result['Done'] = job.done
+		result['Error'] = job.error
+		return result
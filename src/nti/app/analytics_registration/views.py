@@ -11,16 +11,69 @@ logger = __import__('logging').getLogger(__name__)
 
 from nti.app.analytics_registration import MessageFactory as _
 
+import json
+
 from collections import namedtuple
 
 from requests.structures import CaseInsensitiveDict
 
 from datetime import datetime
 
+from hashlib import md5
+
+from zope import component
+
+from zope.cachedescriptors.property import Lazy
+
+from zope.component.hooks import getSite
+
 from pyramid.view import view_config
 
 from pyramid import httpexceptions as hexc
 
+from nti.app.analytics_registration.caches import RegistrationRulesEntry
+
+from nti.app.analytics_registration.courses import get_course_resolver
+
+from nti.app.analytics_registration.counters import get_session_seats
+from nti.app.analytics_registration.counters import count_registration
+
+from nti.app.analytics_registration.enrollment import ENROLLMENT_DROPPED
+
+from nti.app.analytics_registration.enrollment import is_enrolled
+from nti.app.analytics_registration.enrollment import enroll_in_course
+from nti.app.analytics_registration.enrollment import queue_enrollment
+from nti.app.analytics_registration.enrollment import submit_enrollment
+from nti.app.analytics_registration.enrollment import get_course_ntiids
+from nti.app.analytics_registration.enrollment import get_enrollment_job_id
+from nti.app.analytics_registration.enrollment import get_deferred_enrollment
+from nti.app.analytics_registration.enrollment import mark_deferred_enrollment
+from nti.app.analytics_registration.enrollment import clear_deferred_enrollment
+from nti.app.analytics_registration.enrollment import get_registration_course_ntiid
+
+from nti.app.analytics_registration.instrumentation import PHASE_PARSE
+from nti.app.analytics_registration.instrumentation import PHASE_STORAGE
+from nti.app.analytics_registration.instrumentation import PHASE_RESPONSE
+from nti.app.analytics_registration.instrumentation import PHASE_ENROLLMENT
+from nti.app.analytics_registration.instrumentation import PHASE_USER_LOOKUP
+
+from nti.app.analytics_registration.instrumentation import time_phase
+from nti.app.analytics_registration.instrumentation import timed_view
+
+from nti.app.analytics_registration.interfaces import IRegistrationJobQueue
+from nti.app.analytics_registration.interfaces import IRegistrationRulesCache
+
+from nti.app.analytics_registration.jobs import JOB_FAILED
+from nti.app.analytics_registration.jobs import JOB_PENDING
+from nti.app.analytics_registration.jobs import JOB_SUCCESS
+
+from nti.app.analytics_registration.metrics import record_submit_attempt
+
+from nti.app.analytics_registration.questions import note_survey_answers
+
+from nti.app.analytics_registration.rules import get_rule_index
+from nti.app.analytics_registration.rules import get_rules_version
+
 from nti.app.analytics_registration.view_mixins import RegistrationIDViewMixin
 
 from nti.app.base.abstract_views import AbstractAuthenticatedView
@@ -33,15 +86,12 @@ from nti.analytics_registration.exceptions import DuplicateUserRegistrationExcep
 from nti.analytics_registration.exceptions import DuplicateRegistrationSurveyException
 
 from nti.analytics_registration.registration import get_registration_rules
+from nti.analytics_registration.registration import get_user_registrations
 from nti.analytics_registration.registration import store_registration_data
 from nti.analytics_registration.registration import get_registration_sessions
 from nti.analytics_registration.registration import store_registration_survey_data
 
-from nti.contenttypes.courses.interfaces import ES_CREDIT_NONDEGREE
-
-from nti.contenttypes.courses.interfaces import ICourseInstance
-from nti.contenttypes.courses.interfaces import ICourseCatalogEntry
-from nti.contenttypes.courses.interfaces import ICourseEnrollmentManager
+from nti.common.string import is_true
 
 from nti.dataserver import authorization as nauth
 
@@ -50,10 +100,9 @@ from nti.dataserver.interfaces import IUser
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
 
-from nti.ntiids.ntiids import find_object_with_ntiid
-
 from nti.app.analytics_registration import SUBMIT_REGISTRATION_INFO
 from nti.app.analytics_registration import REGISTRATION_ENROLL_RULES
+from nti.app.analytics_registration import REGISTRATION_ENROLLMENT_STATUS
 
 CLASS = StandardExternalFields.CLASS
 MIMETYPE = StandardExternalFields.MIMETYPE
@@ -72,14 +121,21 @@ RegistrationData = namedtuple( 'RegistrationData',
 			 renderer='rest',
 			 request_method='POST',
 			 permission=nauth.ACT_UPDATE)
+@timed_view
 class SubmitRegistrationView(AbstractAuthenticatedView,
 						     ModeledContentUploadRequestUtilsMixin,
 						     RegistrationIDViewMixin):
 	"""
 	We expect regular form POST data here, containing both
-	survey and registration information.
+	survey and registration information. With `defer_enrollment`, the
+	registration is stored and the course enrollment queued to run after
+	commit; poll its state with the enrollment status view.
 	"""
 
+	@Lazy
+	def _course_resolver(self):
+		return get_course_resolver( self.request )
+
 	def _get_registration_data(self, values):
 		"""
 		From the given values dict, return a tuple of registration data
@@ -106,28 +162,50 @@ class SubmitRegistrationView(AbstractAuthenticatedView,
 											  session_range )
 		return registration_data, version, values
 
-	def _enroll(self, user, course_ntiid):
+	def _enroll(self, user, registration_id, course_ntiid):
 		"""
 		Enroll the user in the course mapping to their registration.
 		"""
-		course = None
-		if course_ntiid:
-			course = find_object_with_ntiid( course_ntiid )
-			course = ICourseInstance( course, None )
-
-		if course is None:
+		lookup = self._course_resolver.resolve( course_ntiid )
+		if lookup is None:
 			raise hexc.HTTPUnprocessableEntity( _('Course not found during registration.') )
+		clear_deferred_enrollment( user, registration_id )
+		return enroll_in_course( user, lookup )
 
-		manager = ICourseEnrollmentManager(course)
-		# XXX: We do not have an comparable scope for this type
-		# of enrollment, CREDIT_NONDEGREE is an approximation.
-		record = manager.enroll( user, scope=ES_CREDIT_NONDEGREE )
+	def _defer_enrollment(self, user, registration_id, course_ntiid):
+		"""
+		Queue the enrollment to run after commit, returning its status.
+		"""
+		if self._course_resolver.resolve( course_ntiid ) is None:
+			raise hexc.HTTPUnprocessableEntity( _('Course not found during registration.') )
+		mark_deferred_enrollment( user, registration_id, course_ntiid )
+		site = getSite()
+		site_names = (site.__name__,) if site is not None else ()
+		job_id = queue_enrollment( user.username, registration_id,
+								   course_ntiid, site_names )
+		logger.info( 'Registration enrollment queued (%s) (%s)', user, job_id )
+		self.request.response.status_int = 202
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationEnrollmentStatus'
+		result['JobId'] = job_id
+		result['State'] = JOB_PENDING
+		result['CourseNTIID'] = course_ntiid
+		return result
 
-		entry = ICourseCatalogEntry( course, None )
-		entry_ntiid = entry.ntiid if entry is not None else ''
-		logger.info( 'User enrolled in course during registration (%s) (%s)',
-					 user, entry_ntiid )
-		return record
+	def _validate_choices(self, registration_id, data):
+		"""
+		Check the course choice against the compiled rules before storing
+		anything. Sessions not in the uploaded sessions are allowed.
+		"""
+		rule_index = get_rule_index( registration_id )
+		if not rule_index.is_valid_course( data.school,
+										   data.grade_teaching,
+										   data.course_ntiid ):
+			raise hexc.HTTPUnprocessableEntity(
+					_('Course given is invalid for this registration info.') )
+		if not rule_index.is_valid_session( data.course_ntiid, data.session_range ):
+			logger.info( 'Registration session not in uploaded sessions (%s) (%s) (%s)',
+						 registration_id, data.course_ntiid, data.session_range )
 
 	def _store_data(self, user, registration_id, values):
 		"""
@@ -135,6 +213,10 @@ class SubmitRegistrationView(AbstractAuthenticatedView,
 		"""
 		timestamp = datetime.utcnow()
 		data, version, survey_data = self._get_registration_data( values )
+		self._validate_choices( registration_id, data )
+		seats = get_session_seats()
+		if seats.is_full( registration_id, data.course_ntiid, data.session_range ):
+			raise hexc.HTTPUnprocessableEntity( _('Session is full.') )
 		try:
 			store_registration_data( user, timestamp, registration_id, data )
 		except DuplicateUserRegistrationException:
@@ -143,12 +225,14 @@ class SubmitRegistrationView(AbstractAuthenticatedView,
 		except InvalidCourseMappingException:
 			raise hexc.HTTPUnprocessableEntity(
 					_('Course given is invalid for this registration info.') )
+		count_registration( registration_id, data )
 
 		try:
 			store_registration_survey_data( user, timestamp,
 											registration_id,
 											version,
 											survey_data )
+			note_survey_answers( registration_id, survey_data )
 		except NoUserRegistrationException:
 			# Should not be possible.
 			raise hexc.HTTPUnprocessableEntity( _('User not yet registered.') )
@@ -158,13 +242,82 @@ class SubmitRegistrationView(AbstractAuthenticatedView,
 		return data.course_ntiid
 
 	def __call__(self):
-		values = CaseInsensitiveDict(self.readInput())
-		registration_id = self._get_registration_id( values )
+		record_submit_attempt( self.request )
+		with time_phase( self.request, PHASE_PARSE ):
+			values = CaseInsensitiveDict(self.readInput())
+			registration_id = self._get_registration_id( values )
+		with time_phase( self.request, PHASE_USER_LOOKUP ):
+			user = self.remoteUser
+
+		defer = is_true( values.pop( 'defer_enrollment', None ) )
+		with time_phase( self.request, PHASE_STORAGE ):
+			course_ntiid = self._store_data( user, registration_id, values )
+		with time_phase( self.request, PHASE_ENROLLMENT ):
+			if defer:
+				return self._defer_enrollment( user, registration_id, course_ntiid )
+			record = self._enroll( user, registration_id, course_ntiid )
+		return record
+
+@view_config(route_name='objects.generic.traversal',
+			 name=REGISTRATION_ENROLLMENT_STATUS,
+			 context=IUser,
+			 renderer='rest',
+			 request_method='GET',
+			 permission=nauth.ACT_UPDATE)
+@timed_view
+class RegistrationEnrollmentStatusView(AbstractAuthenticatedView,
+									   RegistrationIDViewMixin):
+	"""
+	Returns the state of a deferred registration enrollment. Jobs only live
+	in the process that queued them; otherwise the state is taken from
+	whether the user is enrolled in the course of their registration.
+
+	A deferred enrollment that has not run, with no job running (it was
+	lost with its process, or failed), is queued again; enrollment is
+	idempotent, so this is safe to retry. Users who did not defer, or were
+	dropped after their enrollment ran, are reported as dropped.
+	"""
+
+	def _requeue(self, user, registration_id, course_ntiid, result):
+		site = getSite()
+		site_names = (site.__name__,) if site is not None else ()
+		job = submit_enrollment( user.username, registration_id,
+								 course_ntiid, site_names )
+		logger.info( 'Registration enrollment queued again (%s) (%s)', user, job.id )
+		result['State'] = job.state
+		result['Requeued'] = True
+		return result
+
+	def __call__(self):
+		registration_id = self._get_registration_id()
 		user = self.remoteUser
+		job_id = get_enrollment_job_id( user.username, registration_id )
+		job = component.getUtility( IRegistrationJobQueue ).get( job_id )
 
-		course_ntiid = self._store_data( user, registration_id, values )
-		record = self._enroll( user, course_ntiid )
-		return record
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationEnrollmentStatus'
+		result['JobId'] = job_id
+		if job is not None and job.state != JOB_FAILED:
+			result['State'] = job.state
+			result['Error'] = job.error
+			return result
+
+		registrations = get_user_registrations( user, registration_id )
+		if not registrations:
+			raise hexc.HTTPNotFound( _('User not yet registered.') )
+		course_ntiids = get_course_ntiids( registration_id )
+		course_ntiid = get_registration_course_ntiid( registrations[0], course_ntiids )
+		result['CourseNTIID'] = course_ntiid
+		result['Error'] = job.error if job is not None else None
+		if is_enrolled( user, course_ntiid, get_course_resolver( self.request ) ):
+			result['State'] = JOB_SUCCESS
+			return result
+		deferred_ntiid = get_deferred_enrollment( user, registration_id )
+		if deferred_ntiid is None:
+			result['State'] = ENROLLMENT_DROPPED
+			return result
+		result['CourseNTIID'] = deferred_ntiid
+		return self._requeue( user, registration_id, deferred_ntiid, result )
 
 @view_config(route_name='objects.generic.traversal',
 			 renderer='rest',
@@ -172,26 +325,26 @@ class SubmitRegistrationView(AbstractAuthenticatedView,
 			 context=IUser,
 			 request_method='GET',
 			 name=REGISTRATION_ENROLL_RULES)
+@timed_view
 class RegistrationRulesView(AbstractAuthenticatedView,
 							RegistrationIDViewMixin):
 	"""
 	Retrieves the registration possibilities. Results
-	should be returned in feed order.
+	should be returned in feed order. `RemainingSeats` gives the open
+	seats of each course session with a capacity.
 	"""
 
-	def __call__(self):
-		registration_id = self._get_registration_id()
+	def _build_rules(self, registration_id):
+		"""
+		Build the rules document, or return None if there are no rules.
+		"""
 		rules = get_registration_rules( registration_id )
 		sessions = get_registration_sessions( registration_id )
 		if not rules or not sessions:
-			raise hexc.HTTPNotFound( _('No registration rules found.') )
+			return None
 
-		result = LocatedExternalDict()
-		result[CLASS] = 'RegistrationRules'
-		result[MIMETYPE] = 'application/vnd.nextthought.analytics.registrationrules'
-
-		result['RegistrationRules'] = registration_dict = {}
-		result['CourseSessions'] = course_session_dict = {}
+		registration_dict = {}
+		course_session_dict = {}
 
 		# Set the courses available per school and grade.
 		for rule in rules:
@@ -206,4 +359,77 @@ class RegistrationRulesView(AbstractAuthenticatedView,
 			session_list = course_session_dict.setdefault( session.course_ntiid, list() )
 			session_list.append( session.session_range )
 
+		return {'RegistrationRules': registration_dict,
+				'CourseSessions': course_session_dict}
+
+	def _get_rules_entry(self, registration_id):
+		"""
+		Return the rules entry for the stored rules version, which may have
+		been stored by another process since this one cached its entry.
+		"""
+		version = get_rules_version( registration_id )
+		cache = component.queryUtility( IRegistrationRulesCache )
+		entry = cache.get( registration_id, version ) if cache is not None else None
+		if entry is None:
+			document = self._build_rules( registration_id )
+			if document is None:
+				return None
+			if cache is not None:
+				entry = cache.set( registration_id, document, version )
+			else:
+				entry = RegistrationRulesEntry( document, None, None, version )
+		return entry
+
+	def _get_remaining_seats(self, registration_id, entry):
+		"""
+		Return the remaining seats per course session, along with an
+		entry whose ETag also covers them. Seats change with every
+		registration, so they are kept out of the cached rules.
+		"""
+		remaining = get_session_seats().get_remaining( registration_id )
+		if remaining and entry.etag is not None:
+			digest = md5( json.dumps( remaining, sort_keys=True ).encode( 'utf-8' ) )
+			etag = '%s-%s' % (entry.etag, digest.hexdigest())
+			# Seats are not timestamped, so only the ETag validates.
+			entry = RegistrationRulesEntry( entry.document, etag, None, entry.version )
+		return remaining, entry
+
+	def _is_not_modified(self, entry):
+		request = self.request
+		if request.if_none_match:
+			return entry.etag in request.if_none_match
+		if request.if_modified_since is not None and entry.last_modified is not None:
+			last_modified = datetime.utcfromtimestamp( int( entry.last_modified ) )
+			if_modified_since = request.if_modified_since.replace( tzinfo=None )
+			return last_modified <= if_modified_since
+		return False
+
+	def _set_cache_headers(self, response, entry):
+		response.etag = entry.etag
+		response.last_modified = entry.last_modified
+
+	def __call__(self):
+		registration_id = self._get_registration_id()
+		with time_phase( self.request, PHASE_STORAGE ):
+			entry = self._get_rules_entry( registration_id )
+		if entry is None:
+			raise hexc.HTTPNotFound( _('No registration rules found.') )
+
+		with time_phase( self.request, PHASE_RESPONSE ):
+			return self._get_response( registration_id, entry )
+
+	def _get_response(self, registration_id, entry):
+		remaining, entry = self._get_remaining_seats( registration_id, entry )
+		if entry.etag is not None:
+			if self._is_not_modified( entry ):
+				not_modified = hexc.HTTPNotModified()
+				self._set_cache_headers( not_modified, entry )
+				return not_modified
+			self._set_cache_headers( self.request.response, entry )
+
+		result = LocatedExternalDict()
+		result[CLASS] = 'RegistrationRules'
+		result[MIMETYPE] = 'application/vnd.nextthought.analytics.registrationrules'
+		result.update( entry.document )
+		result['RemainingSeats'] = remaining
 		return result